@@ -1,4 +1,20 @@
 # IMPORTS
-from .core import *
-from .helper_functions import *
-from .main_grape import *
+# the subpackages import their modules (and tensorflow, matplotlib, IPython, qutip) only when
+# one of their names is first used
+from . import core
+from . import helper_functions
+from . import main_grape
+
+__all__ = core.__all__ + helper_functions.__all__ + main_grape.__all__
+
+
+def __getattr__(name):
+    for package in [core, helper_functions, main_grape]:
+        if name in package.__all__:
+            return getattr(package, name)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,7 +1,48 @@
 # IMPORTS
-from .analysis import *
-from .convergence import *
-from .regularization_functions import *
-from .system_parameters import *
-from .tensorflow_state import *
-from .run_session import *
+# the modules are only imported when one of their names is first used, so that importing
+# the package does not load tensorflow, matplotlib and IPython
+import importlib
+import sys
+import types
+
+_modules = {'Analysis': 'analysis',
+            'NumpyAnalysis': 'analysis',
+            'Convergence': 'convergence',
+            'get_reg_loss': 'regularization_functions',
+            'SystemParameters': 'system_parameters',
+            'TensorflowState': 'tensorflow_state',
+            'NumpyState': 'numpy_state',
+            'get_reg_loss_numpy': 'numpy_state',
+            'run_session': 'run_session',
+            'numpy_run_session': 'run_session'}
+
+__all__ = list(_modules)
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # the import of a module sets it as an attribute of the package, after the module is run:
+        # a name shared with its module (run_session) is bound to the object of the module instead
+        if isinstance(value, types.ModuleType) and _modules.get(name) == name:
+            value = getattr(value, name)
+        types.ModuleType.__setattr__(self, name, value)
+
+
+sys.modules[__name__].__class__ = _Package
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+
+    module = importlib.import_module('.' + _modules[name], __name__)
+    for module_name in _modules:
+        if _modules[module_name] == _modules[name]:
+            globals()[module_name] = getattr(module, module_name)
+
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
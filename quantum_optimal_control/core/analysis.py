@@ -1,43 +1,77 @@
 import numpy as np
-from quantum_optimal_control.helper_functions.grape_functions import sort_ev, get_state_index
+from quantum_optimal_control.helper_functions.grape_functions import sort_ev, get_state_index, c_to_r_mat
 import os
-import tensorflow.compat.v1 as tf
-
-from quantum_optimal_control.helper_functions.data_management import H5File
 
 
 class Analysis:
 
-    def __init__(self, sys_para, tf_final_state, tf_ops_weight, tf_unitary_scale, tf_inter_vecs):
+    def __init__(self, sys_para, tf_final_state, tf_ops_weight, tf_unitary_scale, tf_inter_vecs, writer=None, final=False):
+        # the results are saved through writer (an H5Writer), if given, following the save_policy
+        # (final is True for the analysis of the optimized pulses)
         self.sys_para = sys_para
+        self.writer = writer
+        self.final = final
         self.tf_final_state = tf_final_state
         self.tf_ops_weight = tf_ops_weight
         self.tf_unitary_scale = tf_unitary_scale
         self.tf_inter_vecs = tf_inter_vecs
         self.this_dir = os.path.dirname(__file__)
+        self.snapshot = None
 
     def RtoCMat(self, M):
         # real to complex matrix isomorphism
+        if self.sys_para.use_complex:
+            return M
+
         state_num = self.sys_para.state_num
         M_real = M[:state_num, :state_num]
         M_imag = M[state_num:2*state_num, :state_num]
 
         return (M_real+1j*M_imag)
 
+    def get_snapshot(self):
+        # the final state, the weights, the unitary metric and the inter vectors, evaluated together in
+        # one run (of the existing tensors, without adding ops to the graph) the first time one is needed
+        if self.snapshot is None:
+            import tensorflow.compat.v1 as tf
+
+            fetches = {'final_state': self.tf_final_state, 'ops_weight': self.tf_ops_weight,
+                       'unitary_scale': self.tf_unitary_scale}
+            if self.sys_para.use_inter_vecs and self.tf_inter_vecs is not None:
+                fetches['inter_vecs'] = self.tf_inter_vecs
+            self.snapshot = tf.get_default_session().run(fetches)
+
+        return self.snapshot
+
+    def eval_final_state(self):
+        return self.get_snapshot()['final_state']
+
+    def eval_ops_weight(self):
+        # a copy, the pulses are scaled in place by run_session
+        return np.array(self.get_snapshot()['ops_weight'])
+
+    def get_unitary_scale(self):
+        return self.get_snapshot()['unitary_scale']
+
+    def eval_inter_vecs(self):
+        return np.array(self.get_snapshot()['inter_vecs'])
+
     def get_final_state(self, save=True):
         # get final evolved unitary state
-        M = self.tf_final_state.eval()
+        M = self.eval_final_state()
         CMat = self.RtoCMat(M)
+        if self.sys_para.use_complex:
+            # saved in the real representation, same as the real propagation
+            M = c_to_r_mat(M)
 
-        if self.sys_para.save and save:
-            with H5File(self.sys_para.file_path) as hf:
-                hf.append('final_state', np.array(M))
+        if self.writer is not None and save and (self.final or self.sys_para.save_policy['final_state'] == 'all'):
+            self.writer.append('final_state', M)
 
         return CMat
 
     def get_ops_weight(self):
         # get control field
-        ops_weight = self.tf_ops_weight.eval()
+        ops_weight = self.eval_ops_weight()
 
         return ops_weight
 
@@ -47,57 +81,64 @@ class Analysis:
             return None
 
         state_num = self.sys_para.state_num
-        inter_vecs_mag_squared = []
 
-        inter_vecs_real = []
-        inter_vecs_imag = []
+        inter_vecs = self.eval_inter_vecs()
 
-        if self.sys_para.is_dressed:
-            v_sorted = sort_ev(self.sys_para.v_c, self.sys_para.dressed_id)
-
-        ii = 0
-
-        inter_vecs = tf.stack(self.tf_inter_vecs).eval()
+        if self.sys_para.use_complex:
+            inter_vecs_raw_real = np.real(inter_vecs)
+            inter_vecs_raw_imag = np.imag(inter_vecs)
+        else:
+            inter_vecs_raw_real = inter_vecs[:, 0:state_num, :]
+            inter_vecs_raw_imag = inter_vecs[:, state_num:2*state_num, :]
 
-        if self.sys_para.save:
-            with H5File(self.sys_para.file_path, 'a') as hf:
-                hf.append('inter_vecs_raw_real', np.array(
-                    inter_vecs[:, 0:state_num, :]))
-                hf.append('inter_vecs_raw_imag', np.array(
-                    inter_vecs[:, state_num:2*state_num, :]))
+        policy = self.sys_para.save_policy
+        save = self.writer is not None and (policy['inter_vecs'] == 'all' or
+                                            (policy['inter_vecs'] == 'final' and self.final))
 
-        for inter_vec in inter_vecs:
-            inter_vec_real = (inter_vec[0:state_num, :])
-            inter_vec_imag = (inter_vec[state_num:2*state_num, :])
-            inter_vec_c = inter_vec_real+1j*inter_vec_imag
+        # shaped as (vectors, state_num, time steps)
+        inter_vecs_c = inter_vecs_raw_real + 1j*inter_vecs_raw_imag
 
-            if self.sys_para.is_dressed:
+        if self.sys_para.is_dressed:
+            # in the dressed basis, all the vectors and time steps at once
+            v_sorted = sort_ev(self.sys_para.v_c, self.sys_para.dressed_id)
+            inter_vecs_c = np.einsum('ji,vjt->vit', v_sorted, inter_vecs_c)
 
-                dressed_vec_c = np.dot(np.transpose(v_sorted), inter_vec_c)
+        inter_vecs_mag_squared = np.square(np.abs(inter_vecs_c))
+        inter_vecs_real = np.real(inter_vecs_c)
+        inter_vecs_imag = np.imag(inter_vecs_c)
 
-                inter_vec_mag_squared = np.square(np.abs(dressed_vec_c))
+        if save:
+            # every inter_vecs_step-th time step of the chosen representations
+            inter_vecs_data = {'inter_vecs_raw_real': inter_vecs_raw_real, 'inter_vecs_raw_imag': inter_vecs_raw_imag,
+                               'inter_vecs_mag_squared': inter_vecs_mag_squared, 'inter_vecs_real': inter_vecs_real,
+                               'inter_vecs_imag': inter_vecs_imag}
+            for key in policy['inter_vecs_keys']:
+                self.writer.append(
+                    key, inter_vecs_data[key][..., ::policy['inter_vecs_step']])
 
-                inter_vec_real = np.real(dressed_vec_c)
-                inter_vec_imag = np.imag(dressed_vec_c)
+        return inter_vecs_mag_squared
 
-            else:
-                inter_vec_mag_squared = np.square(np.abs(inter_vec_c))
 
-                inter_vec_real = np.real(inter_vec_c)
-                inter_vec_imag = np.imag(inter_vec_c)
+class NumpyAnalysis(Analysis):
+    # Analysis of the numpy engine, reading the arrays of a NumpyState
 
-            inter_vecs_mag_squared.append(inter_vec_mag_squared)
+    def __init__(self, sys_para, nps, writer=None, final=False):
+        self.sys_para = sys_para
+        self.nps = nps
+        self.writer = writer
+        self.final = final
+        self.this_dir = os.path.dirname(__file__)
 
-            inter_vecs_real.append(inter_vec_real)
-            inter_vecs_imag.append(inter_vec_imag)
+    def eval_final_state(self):
+        if self.sys_para.state_transfer:
+            return self.nps.final_state
+        return self.sys_para.to_state_mat(self.nps.final_state)
 
-            ii += 1
+    def eval_ops_weight(self):
+        return np.array(self.nps.ops_weight)
 
-        if self.sys_para.save:
-            with H5File(self.sys_para.file_path, 'a') as hf:
-                hf.append('inter_vecs_mag_squared',
-                          np.array(inter_vecs_mag_squared))
-                hf.append('inter_vecs_real', np.array(inter_vecs_real))
-                hf.append('inter_vecs_imag', np.array(inter_vecs_imag))
+    def get_unitary_scale(self):
+        return self.nps.unitary_scale
 
-        return inter_vecs_mag_squared
+    def eval_inter_vecs(self):
+        return np.array(self.nps.get_inter_vecs())
@@ -1,8 +1,5 @@
 import time
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from IPython import display
 from quantum_optimal_control.helper_functions.grape_functions import sort_ev
 
 
@@ -43,6 +40,16 @@ class Convergence:
         else:
             self.learning_rate_decay = 2500
 
+        if 'retire_factor' in convergence:
+            self.retire_factor = convergence['retire_factor']
+        else:
+            self.retire_factor = 10.
+
+        if 'retire_tol' in convergence:
+            self.retire_tol = convergence['retire_tol']
+        else:
+            self.retire_tol = 1e-3
+
         if 'min_grad' in convergence:
             self.min_grad = convergence['min_grad']
         else:
@@ -50,6 +57,7 @@ class Convergence:
 
         self.reset_convergence()
         if self.sys_para.show_plots:
+            import matplotlib.pyplot as plt
             plt.figure()
 
     def reset_convergence(self):
@@ -82,6 +90,8 @@ class Convergence:
         self.last_iter += self.update_step
 
     def plot_inter_vecs_general(self, pop_inter_vecs, start):
+        import matplotlib.pyplot as plt
+
         # plot state evolution
         if self.sys_para.draw_list != []:
             for kk in range(len(self.sys_para.draw_list)):
@@ -121,6 +131,10 @@ class Convergence:
         plt.legend(ncol=7)
 
     def plot_summary(self):
+        import matplotlib.pyplot as plt
+        import matplotlib.gridspec as gridspec
+        from IPython import display
+
         # plotting data
 
         if not self.last_iter == 0:
@@ -146,7 +160,7 @@ class Convergence:
         if self.sys_para.show_plots == True:
 
             plt.subplot(gs[index, :], title='Error = %1.2e; Other errors = %1.2e; Unitary Metric: %.5f; Runtime: %.1fs; Estimated Remaining Runtime: %.1fh' % (self.last_cost, self.last_reg_cost-self.last_cost,
-                                                                                                                                                               self.anly.tf_unitary_scale.eval(),
+                                                                                                                                                               self.anly.get_unitary_scale(),
 
                                                                                                                                                                self.runtime,
                                                                                                                                                                self.estimated_runtime))
@@ -0,0 +1,283 @@
+import numpy as np
+
+from quantum_optimal_control.helper_functions.grape_functions import sort_ev
+
+
+class NumpyState:
+    # numpy version of TensorflowState: the same loss, regularization and unitary metric, without
+    # graph building. The propagators are exact matrix exponentials from the eigendecomposition of
+    # the hermitian Hamiltonians, and the gradient is the analytic GRAPE gradient: the inter vectors
+    # are propagated forward, the gradient of the loss with respect to them backward, and the
+    # derivative of each propagator is its Frechet derivative in the eigenbasis
+
+    def __init__(self, sys_para):
+        self.sys_para = sys_para
+
+        self.init_operators()
+        self.init_vectors()
+        self.init_adam()
+
+        self.ops_weight_base = np.array(
+            self.sys_para.ops_weight_base, dtype=np.float64)
+        self.evaluate()
+
+    def init_operators(self):
+        self.H0 = np.array(self.sys_para.H0_c, dtype=complex)
+        self.Hops = np.array(self.sys_para.ops_c, dtype=complex)
+
+        for H in [self.H0] + list(self.Hops):
+            if not np.allclose(H, np.conjugate(np.transpose(H))):
+                raise ValueError(
+                    'The numpy engine needs hermitian H0 and Hops')
+
+        # -i dt H_k, the derivatives of the exponent with respect to the control amplitudes
+        self.ops = -1j*self.sys_para.dt*self.Hops
+
+    def init_vectors(self):
+        # initial vectors and target vectors, shaped as (state_num, number of vectors)
+        self.initial_vectors = np.transpose(
+            np.array(self.sys_para.initial_vectors_c, dtype=complex))
+
+        if self.sys_para.state_transfer:
+            self.target_vecs = np.transpose(
+                np.array(self.sys_para.U_c, dtype=complex))
+            self.first_vectors = self.initial_vectors
+        else:
+            U0 = np.array(self.sys_para.U0_c, dtype=complex)
+            self.target_vecs = np.dot(
+                np.array(self.sys_para.U_c, dtype=complex), self.initial_vectors)
+            self.first_vectors = np.dot(U0, self.initial_vectors)
+
+        self.norm = float(len(self.sys_para.states_concerned_list)**2)
+
+    def init_adam(self):
+        # same update as tf.train.AdamOptimizer
+        self.beta1 = 0.9
+        self.beta2 = 0.999
+        self.epsilon = 1e-8
+        self.adam_m = np.zeros_like(self.sys_para.ops_weight_base)
+        self.adam_v = np.zeros_like(self.sys_para.ops_weight_base)
+        self.adam_t = 0
+
+    def get_propagators(self, ops_weight):
+        # exp(-i dt H_j) for every time step, with the eigendecompositions of the H_j
+        uks = np.array(self.sys_para.ops_max_amp)[:, None]*ops_weight
+        H = self.H0 + np.einsum('ks,kij->sij', uks, self.Hops)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(H)
+        exponents = -1j*self.sys_para.dt*eigenvalues
+        propagators = np.matmul(eigenvectors*np.exp(exponents)[:, None, :],
+                                np.conjugate(np.transpose(eigenvectors, [0, 2, 1])))
+
+        return propagators, eigenvectors, exponents
+
+    def get_inner_product_2D(self, psi1, psi2):
+        # same as TensorflowState.get_inner_product_2D, also returns the overlap
+        overlap = np.sum(psi1*np.conjugate(psi2))
+        return np.square(np.abs(overlap))/self.norm, overlap
+
+    def evaluate(self):
+        # loss, regularized loss, unitary metric and gradient at ops_weight_base
+        steps = self.sys_para.steps
+
+        self.ops_weight = np.sin(self.ops_weight_base)
+        propagators, eigenvectors, exponents = self.get_propagators(
+            self.ops_weight)
+
+        # inter vectors, shaped as (time_steps+1, state_num, number of vectors)
+        inter_vecs = np.zeros(
+            (steps+1,) + np.shape(self.initial_vectors), dtype=complex)
+        inter_vecs[0] = self.initial_vectors
+        inter_vec = self.first_vectors
+        for ii in range(steps):
+            inter_vec = np.dot(propagators[ii], inter_vec)
+            inter_vecs[ii+1] = inter_vec
+        self.inter_vecs_packed = inter_vecs
+
+        if self.sys_para.state_transfer:
+            self.final_state = inter_vecs[steps]
+            self.unitary_scale, _ = self.get_inner_product_2D(
+                self.final_state, self.final_state)
+        else:
+            final_state = np.array(self.sys_para.U0_c, dtype=complex)
+            for ii in range(steps):
+                final_state = np.dot(propagators[ii], final_state)
+            self.final_state = final_state
+            self.unitary_scale = np.sum(np.real(np.dot(np.conjugate(np.transpose(final_state)), final_state))) / \
+                self.sys_para.state_num
+
+        fidelity, overlap = self.get_inner_product_2D(
+            inter_vecs[steps], self.target_vecs)
+        self.loss = 1 - fidelity
+
+        # gradients with respect to the (complex conjugate) inter vectors and the weights
+        vecs_grad = np.zeros_like(inter_vecs)
+        vecs_grad[steps] = -(2/self.norm)*overlap*self.target_vecs
+
+        penalty_loss, weights_grad = get_reg_loss_numpy(self, vecs_grad)
+        self.reg_loss = self.loss + penalty_loss
+
+        # backward propagation of the vector gradients: lambda_{j-1} = K_j^dagger lambda_j + vecs_grad_{j-1}
+        lambdas = np.zeros((steps,) + np.shape(self.initial_vectors), dtype=complex)
+        lambda_j = vecs_grad[steps]
+        for ii in range(steps-1, -1, -1):
+            lambdas[ii] = lambda_j
+            lambda_j = np.dot(np.conjugate(
+                np.transpose(propagators[ii])), lambda_j) + vecs_grad[ii]
+
+        # Re <lambda_j, L(-i dt H_j, -i dt H_k) psi_{j-1}>, with the Frechet derivative
+        # L(A, E) = V (phi o (V^dagger E V)) V^dagger in the eigenbasis V of A
+        prev_vecs = np.concatenate(
+            [self.first_vectors[None], inter_vecs[1:steps]], 0)
+        eigenvectors_adj = np.conjugate(np.transpose(eigenvectors, [0, 2, 1]))
+        prev_vecs = np.matmul(eigenvectors_adj, prev_vecs)
+        lambdas = np.matmul(eigenvectors_adj, lambdas)
+        overlaps = np.matmul(np.conjugate(lambdas),
+                             np.transpose(prev_vecs, [0, 2, 1]))
+
+        # phi_ab = (exp(a)-exp(b))/(a-b) = exp(b) expm1(a-b)/(a-b), exp(b) for a = b
+        differences = exponents[:, :, None] - exponents[:, None, :]
+        degenerate = np.abs(differences) < 1e-12
+        phi = np.exp(exponents)[:, None, :] * \
+            np.where(degenerate, 1.0, np.expm1(differences) /
+                     np.where(degenerate, 1.0, differences))
+
+        overlaps = np.matmul(np.matmul(np.conjugate(eigenvectors), phi*overlaps),
+                             np.transpose(eigenvectors, [0, 2, 1]))
+        uks_grad = np.real(np.einsum('kij,sij->ks', self.ops, overlaps))
+
+        weights_grad = weights_grad + \
+            np.array(self.sys_para.ops_max_amp)[:, None]*uks_grad
+        self.grad = weights_grad*np.cos(self.ops_weight_base)
+        self.grad_squared = 0.5*np.sum(np.square(self.grad))
+
+    def set_ops_weight_base(self, ops_weight_base):
+        self.ops_weight_base = np.array(np.reshape(
+            ops_weight_base, np.shape(self.ops_weight_base)), dtype=np.float64)
+        self.evaluate()
+
+    def apply_adam(self, learning_rate):
+        # one Adam step along the current gradient
+        self.adam_t += 1
+        self.adam_m = self.beta1*self.adam_m + (1-self.beta1)*self.grad
+        self.adam_v = self.beta2*self.adam_v + \
+            (1-self.beta2)*np.square(self.grad)
+        learning_rate_t = learning_rate * \
+            np.sqrt(1-self.beta2**self.adam_t)/(1-self.beta1**self.adam_t)
+
+        self.set_ops_weight_base(self.ops_weight_base - learning_rate_t *
+                                 self.adam_m/(np.sqrt(self.adam_v)+self.epsilon))
+
+    def get_inter_vecs(self):
+        # inter vectors in the representation of the propagation, one (state_dim, time_steps+1) array per vector
+        inter_vecs = np.transpose(self.inter_vecs_packed, [2, 1, 0])
+        if not self.sys_para.use_complex:
+            inter_vecs = np.concatenate(
+                [np.real(inter_vecs), np.imag(inter_vecs)], 1)
+        return list(inter_vecs)
+
+
+def get_reg_loss_numpy(nps, vecs_grad):
+    # penalties of regularization_functions.get_reg_loss and their gradients: returns the penalty,
+    # its gradient with respect to ops_weight, and adds the gradient with respect to the inter vectors to vecs_grad
+    sys_para = nps.sys_para
+    steps = sys_para.steps
+    ops_weight = nps.ops_weight
+
+    penalty_loss = 0.0
+    weights_grad = np.zeros_like(ops_weight)
+
+    # amplitude
+    if 'amplitude' in sys_para.reg_coeffs:
+        amp_reg_alpha = sys_para.reg_coeffs['amplitude'] / float(steps)
+        penalty_loss += amp_reg_alpha * 0.5*np.sum(np.square(ops_weight))
+        weights_grad += amp_reg_alpha * ops_weight
+
+    # gaussian envelope
+    if 'envelope' in sys_para.reg_coeffs:
+        reg_alpha = sys_para.reg_coeffs['envelope'] / float(steps)
+        envelope = sys_para.one_minus_gauss
+        penalty_loss += reg_alpha * \
+            0.5*np.sum(np.square(envelope*ops_weight))
+        weights_grad += reg_alpha * np.square(envelope)*ops_weight
+
+    # Limiting the dwdt and d2wdt2 of control pulse, with two zeros padded at both ends
+    new_weights = np.pad(ops_weight, ((0, 0), (2, 2)), 'constant')
+    new_weights_grad = np.zeros_like(new_weights)
+
+    if 'dwdt' in sys_para.reg_coeffs:
+        dwdt_reg_alpha = sys_para.reg_coeffs['dwdt'] / float(steps)
+        dwdt = (new_weights[:, 1:] - new_weights[:, :steps + 3]) / sys_para.dt
+        penalty_loss += dwdt_reg_alpha * 0.5*np.sum(np.square(dwdt))
+        new_weights_grad[:, 1:] += dwdt_reg_alpha * dwdt / sys_para.dt
+        new_weights_grad[:, :steps + 3] -= dwdt_reg_alpha * dwdt / sys_para.dt
+
+    if 'd2wdt2' in sys_para.reg_coeffs:
+        d2wdt2_reg_alpha = sys_para.reg_coeffs['d2wdt2'] / float(steps)
+        d2wdt2 = (new_weights[:, 2:] - 2 * new_weights[:, 1:steps + 3] +
+                  new_weights[:, :steps + 2]) / (sys_para.dt ** 2)
+        penalty_loss += d2wdt2_reg_alpha * 0.5*np.sum(np.square(d2wdt2))
+        d2wdt2_grad = d2wdt2_reg_alpha * d2wdt2 / (sys_para.dt ** 2)
+        new_weights_grad[:, 2:] += d2wdt2_grad
+        new_weights_grad[:, 1:steps + 3] -= 2 * d2wdt2_grad
+        new_weights_grad[:, :steps + 2] += d2wdt2_grad
+
+    weights_grad += new_weights_grad[:, 2:steps + 2]
+
+    # bandpass filter on the control, sum of the fft magnitudes out of the band
+    if 'bandpass' in sys_para.reg_coeffs:
+        bandpass_reg_alpha = sys_para.reg_coeffs['bandpass'] / float(steps)
+
+        band = np.array(sys_para.reg_coeffs['band'])
+        band_id = (band*sys_para.total_time).astype(int)
+        half_id = int(steps/2)
+
+        mask = np.zeros(steps)
+        mask[0:band_id[0]] = 1
+        mask[band_id[1]:half_id] = 1
+
+        ops_fft = np.fft.fft(ops_weight, axis=1)
+        ops_fft_abs = np.abs(ops_fft)
+        penalty_loss += bandpass_reg_alpha * np.sum(mask*ops_fft_abs)
+
+        # d|F_m|/dw_n = Re(conj(F_m)/|F_m| exp(-2 pi i m n/steps))
+        phases = np.conjugate(ops_fft) / \
+            np.where(ops_fft_abs > 0, ops_fft_abs, 1.0)
+        weights_grad += bandpass_reg_alpha * \
+            np.real(np.fft.fft(mask*phases, axis=1))
+
+    # Limiting the access to forbidden states
+    if 'forbidden_coeff_list' in sys_para.reg_coeffs:
+        inter_vecs = nps.inter_vecs_packed
+        v_dressed = np.identity(sys_para.state_num)
+
+        if sys_para.is_dressed and ('forbid_dressed' in sys_para.reg_coeffs and sys_para.reg_coeffs['forbid_dressed']):
+            v_dressed = np.reshape(sort_ev(sys_para.v_c, sys_para.dressed_id),
+                                   [len(sys_para.dressed_id), len(sys_para.dressed_id)])
+            inter_vecs = np.matmul(np.conjugate(
+                np.transpose(v_dressed)), inter_vecs)
+
+        for inter_reg_alpha_coeff, state in zip(sys_para.reg_coeffs['forbidden_coeff_list'], sys_para.reg_coeffs['states_forbidden_list']):
+            inter_reg_alpha = inter_reg_alpha_coeff / float(steps)
+            # shaped as (time_steps+1, number of vectors)
+            forbidden_state_amp = inter_vecs[:, state, :]
+            forbidden_state_pop = np.square(np.abs(forbidden_state_amp))
+            penalty_loss += inter_reg_alpha * \
+                0.5*np.sum(np.square(forbidden_state_pop))
+            vecs_grad[1:] += 2 * inter_reg_alpha * v_dressed[None, :, state, None] * \
+                (forbidden_state_pop*forbidden_state_amp)[1:, None, :]
+
+    # Speeding up the gate time
+    if 'speed_up' in sys_para.reg_coeffs:
+        speed_up_reg_alpha = sys_para.reg_coeffs['speed_up'] / float(steps)
+
+        overlaps = np.sum(nps.inter_vecs_packed *
+                          np.conjugate(nps.target_vecs)[None], (1, 2))
+        target_vecs_inner_product = np.sum(
+            np.square(np.abs(overlaps)))/nps.norm
+        speed_up_loss = steps + 1 - target_vecs_inner_product
+        penalty_loss += speed_up_reg_alpha * 0.5*np.square(speed_up_loss)
+        vecs_grad[1:] += -speed_up_reg_alpha * speed_up_loss * (2/nps.norm) * \
+            overlaps[1:, None, None]*nps.target_vecs[None]
+
+    return penalty_loss, weights_grad
@@ -1,15 +1,15 @@
 import numpy as np
-import tensorflow.compat.v1 as tf
-from .analysis import Analysis
+from .analysis import Analysis, NumpyAnalysis
+import collections
 import os
 import time
 from scipy.optimize import minimize
 
-from quantum_optimal_control.helper_functions.data_management import H5File
+from quantum_optimal_control.helper_functions.h5_writer import H5Writer
 
 
 class run_session:
-    def __init__(self, tfs, graph, conv, sys_para, method, show_plots=True, single_simulation=False, use_gpu=True):
+    def __init__(self, tfs, graph, conv, sys_para, method, show_plots=True, single_simulation=False, use_gpu=True, session=None, keep_session=False):
         print('run session initialized')
         self.tfs = tfs
         self.graph = graph
@@ -20,89 +20,192 @@ class run_session:
         self.method = method.upper()
         self.show_plots = show_plots
         self.target = False
-        if not use_gpu:
-            config = tf.ConfigProto(device_count={'GPU': 0})
+        # number of calls of save_data, for the history_step of the save_policy
+        self.saves = 0
+        # results of the last scipy evaluations, by weights, and the weights of the last one
+        # when they are not loaded in the weights variable
+        self.error_cache = collections.OrderedDict()
+        self.error_cache_size = 8
+        self.fed_weights = None
+        self.function_evaluations = 0
+        self.cache_hits = 0
+        self.hessian_vector_products = 0
+
+        # the data is written to the file in the background, while optimizing
+        if sys_para.save:
+            self.writer = H5Writer(sys_para.file_path, precision=sys_para.save_policy['precision'],
+                                   compression=sys_para.save_policy['compression'])
         else:
-            config = None
+            self.writer = None
+
+        try:
+            self.start_session(use_gpu, session, keep_session)
+        except BaseException:
+            # the exception raised while optimizing (a KeyboardInterrupt handled by Grape) is the one
+            # propagated: an error of the writer is only printed
+            if self.writer is not None:
+                self.writer.close(raise_error=False)
+            raise
+        if self.writer is not None:
+            self.writer.close()
+
+    def start_session(self, use_gpu, session=None, keep_session=False):
+        # runs in session (a new one if None), which is closed at the end unless keep_session is True
+        import tensorflow.compat.v1 as tf
+
+        if session is None:
+            if not use_gpu:
+                config = tf.ConfigProto(device_count={'GPU': 0})
+            else:
+                config = None
+
+            if self.sys_para.num_threads is not None:
+                if config is None:
+                    config = tf.ConfigProto()
+                config.intra_op_parallelism_threads = self.sys_para.num_threads
+                config.inter_op_parallelism_threads = self.sys_para.num_threads
+
+            session = tf.Session(graph=self.graph, config=config)
+
+        self.session = session
+        try:
+            with self.session.as_default():
+
+                self.session.run(self.tfs.init_op)
+                if self.tfs.sys_para is not self.sys_para:
+                    # a graph built for another system with the same graph key
+                    self.tfs.load_system(self.session, self.sys_para)
+
+                print("Initialized")
+
+                self.optimize()
+        except BaseException:
+            # the session of a failed run is not kept, its variables may be left mid-update
+            self.session.close()
+            raise
+        if not keep_session:
+            self.session.close()
+
+    def optimize(self):
+        if self.method == 'EVOLVE':
+            self.start_time = time.time()
+            x0 = self.sys_para.ops_weight_base
+            self.l, self.rl, self.grads, self.metric, self.g_squared = self.get_error(
+                x0)
+            self.get_end_results()
+
+        elif self.method == 'LBFGS':
+            self.lbfgs_optimize()
 
-        with tf.Session(graph=graph, config=config) as self.session:
+        else:
+            if self.method != 'ADAM':  # Any BFGS scheme
+                self.bfgs_optimize(method=self.method)
 
-            tf.global_variables_initializer().run()
+            if self.method == 'ADAM':
+                self.start_adam_optimizer()
 
-            print("Initialized")
+    def get_loss(self):
+        # squared gradient, loss, regularized loss and unitary metric at the current weights
+        return self.session.run(
+            [self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale])
 
-            if self.method == 'EVOLVE':
-                self.start_time = time.time()
-                x0 = self.sys_para.ops_weight_base
-                self.l, self.rl, self.grads, self.metric, self.g_squared = self.get_error(
-                    x0)
-                self.get_end_results()
+    def apply_adam(self, learning_rate):
+        # one Adam step, returns the loss and the regularized loss of the weights before the step,
+        # evaluated in the same run
+        self.feed_dict = {self.tfs.learning_rate: learning_rate}
 
-            else:
-                if self.method != 'ADAM':  # Any BFGS scheme
-                    self.bfgs_optimize(method=self.method)
+        _, l, rl = self.session.run([self.tfs.optimizer, self.tfs.loss, self.tfs.reg_loss],
+                                    feed_dict=self.feed_dict)
 
-                if self.method == 'ADAM':
-                    self.start_adam_optimizer()
+        return l, rl
+
+    def get_analysis(self, final=False):
+        self.load_weights()
+        return Analysis(self.sys_para, self.tfs.final_state, self.tfs.ops_weight, self.tfs.unitary_scale,
+                        self.tfs.inter_vecs, self.writer, final)
 
     def start_adam_optimizer(self):
         # adam optimizer
         self.start_time = time.time()
         self.end = False
+        # the loss reached conv_target before the last Adam step
+        check_target = False
         while True:
 
-            self.g_squared, self.l, self.rl, self.metric = self.session.run(
-                [self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale])
+            if check_target or self.iterations >= self.conv.max_iterations or \
+                    self.iterations % self.conv.update_step == 0 or self.iterations % self.conv.evol_save_step == 0:
+                # the diagnostics (gradient and unitary metric) and the saved analysis are of the
+                # weights before the step: they are evaluated in their own run
+                self.g_squared, self.l, self.rl, self.metric = self.get_loss()
 
-            if (self.l < self.conv.conv_target) or (self.g_squared < self.conv.min_grad) \
-                    or (self.iterations >= self.conv.max_iterations):
-                self.end = True
+                if (self.l < self.conv.conv_target) or (self.g_squared < self.conv.min_grad) \
+                        or (self.iterations >= self.conv.max_iterations):
+                    self.end = True
 
-            self.update_and_save()
+                self.update_and_save()
 
-            if self.end:
-                self.get_end_results()
-                break
+                if self.end:
+                    self.get_end_results()
+                    break
 
-            learning_rate = float(
-                self.conv.rate) * np.exp(-float(self.iterations) / self.conv.learning_rate_decay)
-            self.feed_dict = {self.tfs.learning_rate: learning_rate}
+                learning_rate = float(
+                    self.conv.rate) * np.exp(-float(self.iterations) / self.conv.learning_rate_decay)
+                self.apply_adam(learning_rate)
 
-            _ = self.session.run([self.tfs.optimizer],
-                                 feed_dict=self.feed_dict)
+            else:
+                # the loss and the Adam step in one run
+                self.iterations += 1
+                learning_rate = float(
+                    self.conv.rate) * np.exp(-float(self.iterations) / self.conv.learning_rate_decay)
+                self.l, self.rl = self.apply_adam(learning_rate)
+
+            check_target = self.l < self.conv.conv_target
 
     def update_and_save(self):
 
         if not self.end:
 
             if (self.iterations % self.conv.update_step == 0):
-                self.anly = Analysis(self.sys_para, self.tfs.final_state, self.tfs.ops_weight, self.tfs.unitary_scale,
-                                     self.tfs.inter_vecs)
+                if self.sys_para.num_starts > 1 and self.method == 'ADAM' and self.iterations > 0:
+                    self.retire_starts()
+                self.anly = self.get_analysis()
                 self.save_data()
                 self.display()
             if (self.iterations % self.conv.evol_save_step == 0):
                 if not (self.sys_para.show_plots == True and (self.iterations % self.conv.update_step == 0)):
-                    self.anly = Analysis(self.sys_para, self.tfs.final_state, self.tfs.ops_weight, self.tfs.unitary_scale,
-                                         self.tfs.inter_vecs)
+                    self.anly = self.get_analysis()
                     if not (self.iterations % self.conv.update_step == 0):
                         self.save_data()
                     self.conv.save_evol(self.anly)
 
             self.iterations += 1
 
+    def retire_starts(self):
+        # stop optimizing (and propagating) the hopeless and the converged starts. Only with Adam:
+        # retiring changes the optimized loss, which the line searches and the curvature history
+        # (and the cached evaluations) of the other optimizers rely on
+        self.load_weights()
+        self.session.run(self.tfs.retire_starts, feed_dict={self.tfs.retire_factor: self.conv.retire_factor,
+                                                            self.tfs.retire_tol: self.conv.retire_tol,
+                                                            self.tfs.retire_min_grad: self.conv.min_grad})
+
     def get_end_results(self):
         # get optimized pulse and propagation
 
         # get and save inter vects
 
-        self.anly = Analysis(self.sys_para, self.tfs.final_state, self.tfs.ops_weight, self.tfs.unitary_scale,
-                             self.tfs.inter_vecs)
-        self.save_data()
+        self.anly = self.get_analysis(final=True)
+        self.save_data(final=True)
         self.display()
         if not self.show_plots:
             self.conv.save_evol(self.anly)
 
         self.uks = self.Get_uks()
+        if self.sys_para.num_starts > 1 and self.writer is not None:
+            # pulses of all starts, the best one is uks
+            start_uks = self.session.run(
+                self.tfs.ops_weights)*np.reshape(self.sys_para.ops_max_amp, [1, -1, 1])
+            self.writer.add('start_uks', start_uks)
         if not self.sys_para.state_transfer:
             self.Uf = self.anly.get_final_state()
         else:
@@ -116,29 +219,61 @@ class run_session:
         return uks
 
     def get_error(self, uks):
-        # get error and gradient for scipy bfgs:
-        self.session.run(self.tfs.ops_weight_base.assign(uks))
+        # get error and gradient for scipy bfgs, with the weights fed to the evaluation
+        g, l, rl, metric, g_squared, self.optimized_loss = self.session.run(
+            [self.tfs.grad_pack, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale, self.tfs.grad_squared,
+             self.tfs.optimized_loss], feed_dict={self.tfs.ops_weight_base_feed: uks})
 
-        g, l, rl, metric, g_squared = self.session.run(
-            [self.tfs.grad_pack, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale, self.tfs.grad_squared])
+        final_g = np.reshape(g, [-1])
 
-        final_g = np.transpose(np.reshape(
-            g, (len(self.sys_para.ops_c)*self.sys_para.steps)))
+        return l, rl, final_g, metric, g_squared
+
+    def get_cached_error(self, uks):
+        # get_error, from the cache when the same weights were evaluated recently (by the line searches)
+        uks = np.array(uks)
+        key = uks.tobytes()
+        if key in self.error_cache:
+            self.error_cache.move_to_end(key)
+            self.cache_hits += 1
+        else:
+            self.error_cache[key] = self.get_error(uks) + (self.optimized_loss,)
+            self.function_evaluations += 1
+            if len(self.error_cache) > self.error_cache_size:
+                self.error_cache.popitem(last=False)
+
+        self.fed_weights = uks
+        l, rl, final_g, metric, g_squared, self.optimized_loss = self.error_cache[key]
 
         return l, rl, final_g, metric, g_squared
 
-    def save_data(self):
-        if self.sys_para.save:
-            self.elapsed = time.time() - self.start_time
-            with H5File(self.sys_para.file_path, 'a') as hf:
-                print(list(hf.keys()))
-                print(self.l)
-                hf.append('error', np.array(self.l))
-                hf.append('reg_error', np.array(self.rl))
-                hf.append('uks', np.array(self.Get_uks()))
-                hf.append('iteration', np.array(self.iterations))
-                hf.append('run_time', np.array(self.elapsed))
-                hf.append('unitary_scale', np.array(self.metric))
+    def load_weights(self):
+        # the weights of the last evaluation into the weights variable, for the analysis
+        if self.fed_weights is not None:
+            self.session.run(self.tfs.assign_ops_weight_base, feed_dict={
+                             self.tfs.ops_weight_base_input: self.fed_weights})
+            self.fed_weights = None
+
+    def save_data(self, final=False):
+        # the history is saved every history_step calls (and at the end)
+        policy = self.sys_para.save_policy
+        self.saves += 1
+        self.elapsed = time.time() - self.start_time
+        if self.sys_para.save and (final or (self.saves - 1) % policy['history_step'] == 0):
+            self.writer.append('error', np.array(self.l))
+            self.writer.append('reg_error', np.array(self.rl))
+            if final or policy['uks'] == 'all':
+                self.writer.append('uks', np.array(self.Get_uks()))
+            self.writer.append('iteration', np.array(self.iterations))
+            self.writer.append('run_time', np.array(self.elapsed))
+            self.writer.append('unitary_scale', np.array(self.metric))
+            if self.sys_para.num_starts > 1:
+                start_errors, start_active = self.session.run(
+                    [self.tfs.start_losses, self.tfs.start_active])
+                self.writer.append('start_errors', start_errors)
+                self.writer.append('start_active', start_active)
+            if self.sys_para.ensemble is not None:
+                self.writer.append('ensemble_errors', self.session.run(
+                    self.tfs.ensemble_losses))
 
     def display(self):
         # display of simulation results
@@ -151,8 +286,8 @@ class run_session:
 
     def minimize_opt_fun(self, x):
         # minimization function called by scipy in each iteration
-        self.l, self.rl, self.grads, self.metric, self.g_squared = self.get_error(
-            np.reshape(x, (len(self.sys_para.ops_c), int(len(x)/len(self.sys_para.ops_c)))))
+        self.l, self.rl, self.grads, self.metric, self.g_squared = self.get_cached_error(
+            np.reshape(x, self.sys_para.raw_shape))
 
         if self.l < self.conv.conv_target:
             self.conv_time = time.time()-self.start_time
@@ -163,10 +298,20 @@ class run_session:
 
         self.update_and_save()
 
+        # the regularized loss, summed over the starts
         if self.method == 'L-BFGS-B':
-            return np.float64(self.rl), np.float64(np.transpose(self.grads))
+            return np.float64(self.optimized_loss), np.float64(np.transpose(self.grads))
         else:
-            return self.rl, np.reshape(np.transpose(self.grads), [len(np.transpose(self.grads))])
+            return np.float64(self.optimized_loss), np.float64(np.reshape(np.transpose(self.grads), [len(np.transpose(self.grads))]))
+
+    def get_hessian_vector_product(self, x, p):
+        # Hessian of the optimized loss at the weights x times p, for the scipy trust region methods
+        self.hessian_vector_products += 1
+        hessp = self.session.run(self.tfs.hessian_vector_product, feed_dict={
+            self.tfs.ops_weight_base_feed: np.reshape(x, self.sys_para.raw_shape),
+            self.tfs.hessian_vector: np.reshape(p, self.sys_para.raw_shape)})
+
+        return np.float64(np.reshape(hessp, [-1]))
 
     def bfgs_optimize(self, method='L-BFGS-B', jac=True, options=None):
         # scipy optimizer
@@ -178,20 +323,40 @@ class run_session:
         print("Starting " + self.method + " Optimization")
         self.start_time = time.time()
 
-        x0 = self.sys_para.ops_weight_base
-        options = {'maxfun': self.conv.max_iterations,
-                   'gtol': self.conv.min_grad, 'disp': False, 'maxls': 40}
+        # scipy works on flat float64 parameter vectors
+        x0 = np.float64(np.reshape(self.sys_para.ops_weight_base, [-1]))
+        if self.sys_para.second_order:
+            # trust region Newton steps, with the exact Hessian vector products
+            options = {'maxiter': self.conv.max_iterations,
+                       'gtol': self.conv.min_grad, 'disp': False}
+            hessp = self.get_hessian_vector_product
+        else:
+            options = {'maxfun': self.conv.max_iterations,
+                       'gtol': self.conv.min_grad, 'disp': False, 'maxls': 40}
+            hessp = None
 
         res = minimize(self.minimize_opt_fun, x0,
-                       method=method, jac=jac, options=options)
-
-        uks = np.reshape(res['x'], (len(self.sys_para.ops_c),
-                                    int(len(res['x'])/len(self.sys_para.ops_c))))
+                       method=method, jac=jac, hessp=hessp, options=options)
 
         print(self.method + ' optimization done')
 
-        g, l, rl = self.session.run(
-            [self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss])
+        # the end results are of the optimized weights
+        self.get_cached_error(np.reshape(res['x'], self.sys_para.raw_shape))
+        self.load_weights()
+        g, l, rl, _ = self.get_loss()
+
+        print("%d function evaluations, %d cached" %
+              (self.function_evaluations, self.cache_hits))
+        if self.sys_para.second_order:
+            print("%d Hessian vector products" %
+                  (self.hessian_vector_products))
+        if self.writer is not None:
+            self.writer.add('function_evaluations',
+                            self.function_evaluations)
+            self.writer.add('cache_hits', self.cache_hits)
+            if self.sys_para.second_order:
+                self.writer.add('hessian_vector_products',
+                                self.hessian_vector_products)
 
         if self.sys_para.show_plots == False:
             print(res.message)
@@ -199,3 +364,130 @@ class run_session:
             print(("Total time is " + str(time.time() - self.start_time)))
 
         self.get_end_results()
+
+
+    def lbfgs_evaluate(self, step=None):
+        # optimized loss, loss, regularized loss and derivative along the direction at the weights
+        # (first moved to step along the direction)
+        if step is not None:
+            self.session.run(self.tfs.lbfgs_set_step, feed_dict={
+                             self.tfs.lbfgs_step: step})
+        self.function_evaluations += 1
+
+        return self.session.run(self.tfs.lbfgs_evaluate)
+
+    def lbfgs_line_search(self, f0, gd0, max_steps=20):
+        # line search along the direction until the weak Wolfe conditions hold: sufficient decrease
+        # (Armijo), and a derivative along the direction reduced by 0.9. The steps are doubled while
+        # the loss decreases steeply, then taken inside the bracket [lower, upper] (from the minimum
+        # of the quadratic interpolation of the loss for the first upper bound)
+        lower = 0.
+        upper = np.inf
+        step = 1.
+        for ii in range(max_steps):
+            f, l, rl, gd = self.lbfgs_evaluate(step)
+            if not np.isfinite(f) or f > f0 + 1e-4*step*gd0:
+                upper = step
+                if lower == 0. and np.isfinite(f):
+                    new_step = -gd0*step*step/(2*(f - f0 - gd0*step))
+                    step = min(max(new_step, 0.1*step), 0.5*step)
+                else:
+                    step = 0.5*(lower + upper)
+            elif gd < 0.9*gd0:
+                lower = step
+                step = 2*step if upper == np.inf else 0.5*(lower + upper)
+            else:
+                self.f, self.l, self.rl = f, l, rl
+                return True
+
+        # back to the last step with a sufficient decrease, or to the last accepted weights
+        self.f, self.l, self.rl, _ = self.lbfgs_evaluate(lower)
+        return lower > 0.
+
+    def lbfgs_optimize(self, ftol=2.2e-9, max_stalls=2):
+        # L-BFGS in the graph: the weights, gradients and history stay in the session.
+        # As scipy L-BFGS-B, the optimization stops when the relative decrease of the loss in an iteration,
+        # (f_k - f_k+1)/max(|f_k|, |f_k+1|, 1), is below ftol. After a failed line search the history is
+        # reset (the next step is along the gradient), and the optimization stops after max_stalls in a row
+        self.conv.reset_convergence()
+        self.end = False
+        print("Starting " + self.method + " Optimization")
+        self.start_time = time.time()
+
+        self.f, self.l, self.rl, _ = self.lbfgs_evaluate()
+        self.session.run(self.tfs.lbfgs_reset)
+        gd, self.g_squared = self.session.run(self.tfs.lbfgs_accept)
+        stalls = 0
+        converged = False
+
+        while True:
+            if (self.l < self.conv.conv_target) or (self.g_squared < self.conv.min_grad) \
+                    or (self.iterations >= self.conv.max_iterations) or converged or stalls >= max_stalls:
+                self.end = True
+
+            if self.end or self.iterations % self.conv.update_step == 0 or self.iterations % self.conv.evol_save_step == 0:
+                self.metric = self.session.run(self.tfs.unitary_scale)
+
+            self.update_and_save()
+
+            if self.end:
+                print(self.method + ' optimization done')
+                print("%d function evaluations" % (self.function_evaluations))
+                if self.writer is not None:
+                    self.writer.add('function_evaluations',
+                                    self.function_evaluations)
+                self.get_end_results()
+                break
+
+            f_previous = self.f
+            if self.lbfgs_line_search(self.f, gd):
+                stalls = 0
+                converged = f_previous - self.f <= ftol * \
+                    max(abs(f_previous), abs(self.f), 1.)
+            else:
+                # again along the gradient, without the history
+                self.session.run(self.tfs.lbfgs_reset)
+                stalls += 1
+
+            gd, self.g_squared = self.session.run(self.tfs.lbfgs_accept)
+
+
+class numpy_run_session(run_session):
+    # same optimization loop and saving with the numpy engine: nps is a NumpyState, and there is no session
+
+    def __init__(self, nps, conv, sys_para, method, show_plots=True, single_simulation=False, use_gpu=False):
+        run_session.__init__(self, nps, None, conv, sys_para, method, show_plots=show_plots,
+                             single_simulation=single_simulation, use_gpu=use_gpu)
+
+    def start_session(self, use_gpu, session=None, keep_session=False):
+        print("Initialized")
+
+        self.optimize()
+
+    def get_loss(self):
+        return self.tfs.grad_squared, self.tfs.loss, self.tfs.reg_loss, self.tfs.unitary_scale
+
+    def apply_adam(self, learning_rate):
+        l, rl = self.tfs.loss, self.tfs.reg_loss
+        self.tfs.apply_adam(learning_rate)
+
+        return l, rl
+
+    def get_analysis(self, final=False):
+        self.load_weights()
+        return NumpyAnalysis(self.sys_para, self.tfs, self.writer, final)
+
+    def load_weights(self):
+        if self.fed_weights is not None:
+            if not np.array_equal(self.fed_weights, self.tfs.ops_weight_base):
+                self.tfs.set_ops_weight_base(self.fed_weights)
+            self.fed_weights = None
+
+    def get_error(self, uks):
+        # get error and gradient for scipy bfgs:
+        self.tfs.set_ops_weight_base(uks)
+
+        final_g = np.reshape(self.tfs.grad, [-1])
+        self.optimized_loss = self.tfs.reg_loss
+
+        return self.tfs.loss, self.tfs.reg_loss, final_g, self.tfs.unitary_scale, self.tfs.grad_squared
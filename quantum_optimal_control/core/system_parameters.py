@@ -1,26 +1,103 @@
 import numpy as np
+import math
 from quantum_optimal_control.helper_functions.grape_functions import c_to_r_mat
 from quantum_optimal_control.helper_functions.grape_functions import c_to_r_vec
 from quantum_optimal_control.helper_functions.grape_functions import get_state_index
-import scipy.linalg as la
-from scipy.special import factorial
 
 from quantum_optimal_control.helper_functions.data_management import H5File
+from quantum_optimal_control.helper_functions.operator_cache import OperatorCache
 
 
 class SystemParameters:
 
     def __init__(self, H0, Hops, Hnames, U, U0, total_time, steps, states_concerned_list, dressed_info, maxA, draw, initial_guess, show_plots, Unitary_error, state_transfer, no_scaling, reg_coeffs, save, file_path, Taylor_terms, use_gpu, use_inter_vecs, sparse_H,
-                 sparse_U, sparse_K):
+                 sparse_U, sparse_K, propagation='unrolled', use_complex=False, precision='float32', exact_gradient=False, checkpoints=None, exp_method='auto', krylov_dim=None, engine='tensorflow', num_starts=1, ensemble=None, num_threads=None, operator_cache=None, operator_cache_size=2**30, save_policy=None, second_order=False, lbfgs=False, cache_graph=False):
         # Input variable
+        if propagation not in ['unrolled', 'scan', 'batched', 'tree', 'reverse']:
+            raise ValueError(
+                'propagation should be one of: unrolled, scan, batched, tree, reverse. Got: %s' % (propagation))
+        self.propagation = propagation
+        self.use_complex = use_complex
+        if precision not in ['float32', 'float64', 'mixed']:
+            raise ValueError(
+                'precision should be one of: float32, float64, mixed. Got: %s' % (precision))
+        self.precision = precision
+        self.exact_gradient = exact_gradient
+        if checkpoints is not None and checkpoints < 1:
+            raise ValueError(
+                'checkpoints should be a positive integer or None. Got: %s' % (checkpoints))
+        if checkpoints is not None and propagation != 'reverse':
+            raise ValueError(
+                'checkpoints are only used with propagation = reverse. Got propagation: %s' % (propagation))
+        self.checkpoints = checkpoints
+        if exp_method not in ['auto', 'taylor', 'pade', 'krylov']:
+            raise ValueError(
+                'exp_method should be one of: auto, taylor, pade, krylov. Got: %s' % (exp_method))
+        if exp_method == 'pade' and state_transfer:
+            raise ValueError(
+                'Pade propagation is only available for unitary evolution (state_transfer = False)')
+        if exp_method == 'krylov':
+            if not state_transfer:
+                raise ValueError(
+                    'Krylov propagation is only available for state transfer')
+        self.exp_method = exp_method
+        if engine not in ['tensorflow', 'numpy']:
+            raise ValueError(
+                'engine should be one of: tensorflow, numpy. Got: %s' % (engine))
+        self.engine = engine
+        if num_starts < 1:
+            raise ValueError(
+                'num_starts should be at least 1. Got: %s' % (num_starts))
+        if num_starts > 1 and (propagation != 'batched' or engine != 'tensorflow'):
+            raise ValueError(
+                'Multiple starts (num_starts > 1) need propagation = batched with the tensorflow engine')
+        if exp_method == 'krylov' and (num_starts > 1 or ensemble is not None):
+            raise ValueError(
+                'Krylov propagation is not available with multiple starts (num_starts > 1) or an ensemble')
+        self.num_starts = num_starts
+        if ensemble is not None:
+            if propagation != 'batched' or engine != 'tensorflow':
+                raise ValueError(
+                    'An ensemble of Hamiltonians needs propagation = batched with the tensorflow engine')
+            if num_starts > 1:
+                raise ValueError(
+                    'An ensemble of Hamiltonians cannot be combined with multiple starts (num_starts > 1)')
+            if 'H0' not in ensemble and 'Hops' not in ensemble:
+                raise ValueError(
+                    'ensemble should include a list of H0 and/or a list of Hops')
+            if ensemble.get('loss', 'average') not in ['average', 'worst']:
+                raise ValueError(
+                    'ensemble loss should be one of: average, worst. Got: %s' % (ensemble['loss']))
+        self.ensemble = ensemble
+        if second_order:
+            if engine != 'tensorflow':
+                raise ValueError(
+                    'The trust region methods are only available with the tensorflow engine')
+            if propagation == 'reverse' or exp_method == 'krylov':
+                raise ValueError(
+                    'The trust region methods are not available with propagation = reverse or exp_method = krylov')
+        self.second_order = second_order
+        # the in-graph L-BFGS variables and operations are only built for method = 'LBFGS'
+        self.lbfgs = lbfgs
+        self.cache_graph = cache_graph
+        self.num_threads = num_threads
+        if operator_cache is not None:
+            self.operator_cache = OperatorCache(
+                operator_cache, operator_cache_size)
+        else:
+            self.operator_cache = None
+        self.krylov_dim = krylov_dim
         self.sparse_U = sparse_U
         self.sparse_H = sparse_H
         self.sparse_K = sparse_K
+        # Hamiltonians denser than this are kept dense, even with sparse_H
+        self.sparse_density = 0.1
         self.use_inter_vecs = use_inter_vecs
         self.use_gpu = use_gpu
         self.Taylor_terms = Taylor_terms
         self.dressed_info = dressed_info
         self.reg_coeffs = reg_coeffs
+        self.init_save_policy(save_policy)
         self.file_path = file_path
         self.state_transfer = state_transfer
         self.no_scaling = no_scaling
@@ -54,15 +131,16 @@ class SystemParameters:
 
         self.is_dressed = False
         self.U0_c = U0
+        self.U_c = U
         # CtoRMat is converting complex matrices to their equivalent real (double the size) matrices
-        self.initial_unitary = c_to_r_mat(U0)
+        self.initial_unitary = self.to_state_mat(U0)
         if self.state_transfer == False:
-            self.target_unitary = c_to_r_mat(U)
+            self.target_unitary = self.to_state_mat(U)
         else:
             self.target_vectors = []
 
             for target_vector_c in U:
-                self.target_vector = c_to_r_vec(target_vector_c)
+                self.target_vector = self.to_state_vec(target_vector_c)
                 self.target_vectors.append(self.target_vector)
 
         if draw is not None:
@@ -81,10 +159,32 @@ class SystemParameters:
 
         self.init_system()
         self.init_vectors()
+        self.init_operator_cache()
         self.init_operators()
+        self.init_sparse()
+        self.init_exp_method()
+        self.save_operator_cache()
+        if self.ensemble is not None:
+            self.init_ensemble()
+        if self.exp_method == 'krylov':
+            self.init_krylov()
         self.init_one_minus_gaussian_envelope()
         self.init_guess()
 
+    def to_state_mat(self, M):
+        # matrix in the representation used for propagation: complex, or its real equivalent
+        if self.use_complex:
+            return np.array(M, dtype=complex)
+        else:
+            return c_to_r_mat(M)
+
+    def to_state_vec(self, V):
+        # vector in the representation used for propagation: complex, or its real equivalent
+        if self.use_complex:
+            return np.array(V, dtype=complex)
+        else:
+            return c_to_r_vec(V)
+
     def approx_expm(self, M, exp_t, scaling_terms):
         # approximate the exp at the beginning to estimate the number of taylor terms and scaling and squaring needed
         U = np.identity(len(M), dtype=M.dtype)
@@ -102,68 +202,240 @@ class SystemParameters:
 
         return U
 
-    def approx_exp(self, M, exp_t, scaling_terms):
-        # the scaling and squaring of matrix exponential with taylor expansions
-        U = 1.0
-        Mt = 1.0
-        factorial = 1.0  # for factorials
-
-        for ii in range(1, exp_t):
-            factorial *= ii
-            Mt = M*Mt
-            # scaling by 2**scaling_terms
-            U += Mt/((2.**float(ii*scaling_terms))*factorial)
-
-        for ii in range(scaling_terms):
-            U = np.dot(U, U)  # squaring scaling times
-
-        return U
-
-    def Choose_exp_terms(self, d):
-        # given our hamiltonians and a number of scaling/squaring, we determine the number of Taylor terms
-
-        exp_t = 20  # maximum
-
-        H = self.H0_c
-        U_f = self.U0_c
-        for ii in range(len(self.ops_c)):
-            H = H + self.ops_max_amp[ii]*self.ops_c[ii]
-        if d == 0:
-            self.scaling = max(
-                int(2*np.log2(np.max(np.abs(-(0+1j) * self.dt*H)))), 0)
-
-        else:
-            self.scaling += d
-
-        if self.state_transfer or self.no_scaling:
-            self.scaling = 0
-        while True:
-
-            if len(self.H0_c) < 10:
-                for ii in range(self.steps):
-                    U_f = np.dot(U_f, self.approx_expm(
-                        (0-1j)*self.dt*H, exp_t, self.scaling))
-                Metric = np.abs(
-                    np.trace(np.dot(np.conjugate(np.transpose(U_f)), U_f)))/(self.state_num)
+    def get_log_series(self, p, terms=150):
+        # coefficients of the power series of log(p(x)) up to x**terms, for a polynomial p with p[0] = 1:
+        # from p' = p log(p)', k l_k = k p_k - sum over j < k of j l_j p_(k-j)
+        p = np.concatenate([p, np.zeros(terms + 1 - len(p))])
+        l = np.zeros(terms + 1)
+        for k in range(1, terms + 1):
+            l[k] = (k*p[k] - np.dot(np.arange(1, k)*l[1:k], p[k-1:0:-1]))/k
+
+        return l
+
+    def get_theta(self, h, order, tol):
+        # largest norm x of the scaled exponent with a relative backward error below tol (Higham, The scaling
+        # and squaring method for the matrix exponential revisited, 2005): the approximant of exp(B) is
+        # exp(B + dB), with dB = h(B) and h(x) = sum over k > order of h_k x**k,
+        # so that |dB|/|B| <= sum of |h_k| x**(k-1)
+        powers = np.arange(order + 1, len(h)) - 1.
+
+        def get_bound(x):
+            return np.sum(np.abs(h[order+1:])*x**powers)
+
+        lower = 0.
+        upper = 1.
+        while get_bound(upper) <= tol and upper < 1e3:
+            upper = 2*upper
+        for ii in range(60):
+            if get_bound((lower + upper)/2) <= tol:
+                lower = (lower + upper)/2
             else:
-                max_term = np.max(np.abs(-(0+1j) * self.dt*H))
-
-                Metric = 1 + self.steps * \
-                    np.abs((self.approx_exp(max_term, exp_t,
-                                            self.scaling) - np.exp(max_term))/np.exp(max_term))
-
-            if exp_t == 3:
-                break
-            if np.abs(Metric - 1.0) < self.Unitary_error:
-                exp_t = exp_t-1
+                upper = (lower + upper)/2
+
+        return lower
+
+    def get_backward_error_tol(self, norm):
+        # relative backward error of each propagator keeping the error of the evolution below Unitary_error:
+        # exp(A + dA) differs from exp(A) by about |dA| for anti-hermitian A, which adds up over the steps,
+        # and the squarings keep the relative backward error (exp(B + dB)**(2**s) = exp(A + 2**s dB))
+        return self.Unitary_error/(self.steps*norm)
+
+    def get_taylor_theta(self, exp_t, tol):
+        # theta of the Taylor series of degree exp_t: h(x) = log(exp(-x) T(x))
+        h = self.get_log_series(
+            np.array([1./math.factorial(k) for k in range(exp_t + 1)]))
+        h[1] = h[1] - 1
+
+        return self.get_theta(h, exp_t, tol)
+
+    def get_pade_theta(self, order, tol):
+        # theta of the Pade [m/m] approximant p(x)/p(-x): h(x) = log(exp(-x) p(x)/p(-x)), with only odd powers
+        m = order
+        p = np.array([math.factorial(2*m - k)*math.factorial(m)/(math.factorial(2*m)*math.factorial(k)*math.factorial(m - k))
+                      for k in range(m + 1)])
+        log_p = self.get_log_series(p)
+        h = np.zeros_like(log_p)
+        h[1::2] = 2*log_p[1::2]
+        h[1] = h[1] - 1
+
+        return self.get_theta(h, 2*m, tol)
+
+    def get_unitarity_error(self, M, exp_t, scaling_terms):
+        # deviation from unitarity of the evolution of all time steps with the Taylor series of degree exp_t,
+        # the propagator to the power steps is computed by binary powering
+        U_f = np.dot(self.U0_c, np.linalg.matrix_power(
+            self.approx_expm(M, exp_t+1, scaling_terms), self.steps))
+        Metric = np.abs(
+            np.trace(np.dot(np.conjugate(np.transpose(U_f)), U_f)))/(self.state_num)
+
+        return np.abs(Metric - 1.0)
+
+    def get_max_exponent(self):
+        # exponent of the propagator of one time step at the maximum amplitudes, and its 1-norm,
+        # for the ensemble variant with the largest norm
+        if self.ensemble is None:
+            variants = [(self.H0_c, self.ops_c)]
+        else:
+            variants = zip(*self.get_ensemble_variants())
+
+        norm = -1
+        for H0_c, ops_c in variants:
+            H = H0_c
+            for ii in range(len(ops_c)):
+                H = H + self.ops_max_amp[ii]*ops_c[ii]
+            M_variant = (0-1j)*self.dt*H
+            if np.linalg.norm(M_variant, 1) > norm:
+                M = M_variant
+                norm = np.linalg.norm(M, 1)
+
+        if self.cache_graph and norm > 0:
+            # the terms are part of the graph key: they are chosen for the norm rounded up to a power of 2,
+            # so that the systems of a parameter loop with norms within a factor 2 share their graph
+            norm = 2.**np.ceil(np.log2(norm))
+
+        return M, norm
+
+    def Choose_exp_terms(self):
+        # number of Taylor terms and of scaling and squaring with the fewest matrix products (their sum),
+        # such that the backward error bound at the maximum amplitudes keeps the error below Unitary_error
+        exp_min = 3
+        exp_max = 20
+
+        M, norm = self.get_max_exponent()
+
+        if norm == 0:
+            return exp_min, 0
+
+        tol = self.get_backward_error_tol(norm)
+        exp_terms = None
+        for exp_t in range(exp_min, exp_max+1):
+            # the fewest squarings bringing the norm below theta
+            theta = self.get_taylor_theta(exp_t, tol)
+            if self.state_transfer or self.no_scaling:
+                if norm > theta:
+                    continue
+                scaling_terms = 0
             else:
-                break
-
-        return exp_t
+                scaling_terms = max(int(np.ceil(np.log2(norm/theta))), 0)
+            # on a tie, fewer squarings
+            if exp_terms is None or exp_t + scaling_terms <= exp_terms + scaling:
+                exp_terms = exp_t
+                scaling = scaling_terms
+
+        if exp_terms is None:
+            # without squarings, even exp_max terms do not reach the error bound: the series would diverge
+            raise ValueError('The Taylor series of degree %d cannot propagate a time step of norm %.3g within the Unitary_error '
+                             '%g without scaling and squaring (theta = %.3g): use more steps, %s' % (
+                                 exp_max, norm, self.Unitary_error, self.get_taylor_theta(exp_max, tol),
+                                 "exp_method = 'krylov' or Taylor_terms" if self.state_transfer else 'no_scaling = False or Taylor_terms'))
+
+        if len(self.H0_c) < 10 and not self.cache_graph:
+            # the bound is conservative for small systems: fewer terms as long as the evolution stays unitary
+            while exp_terms > exp_min and self.get_unitarity_error(M, exp_terms-1, scaling) < self.Unitary_error:
+                exp_terms = exp_terms - 1
+
+        if self.state_transfer:
+            # the state vectors are propagated with the series of degree exp_terms-1
+            exp_terms = exp_terms + 1
+
+        return exp_terms, scaling
+
+    def Choose_pade_terms(self):
+        # order of the Pade [m/m] approximant and number of scaling and squaring with the fewest matrix
+        # products, such that the backward error bound at the maximum amplitudes keeps the error below
+        # Unitary_error
+        M, norm = self.get_max_exponent()
+
+        if norm == 0:
+            return 3, 0
+
+        tol = self.get_backward_error_tol(norm)
+        pade_order = None
+        for order in sorted(self.pade_products):
+            scaling_terms = max(
+                int(np.ceil(np.log2(norm/self.get_pade_theta(order, tol)))), 0)
+            # on a tie, fewer squarings
+            if pade_order is None or self.pade_products[order] + scaling_terms <= self.pade_products[pade_order] + scaling:
+                pade_order = order
+                scaling = scaling_terms
+
+        return pade_order, scaling
+
+    def init_exp_method(self):
+        # with exp_method = auto, the Pade approximant is used for unitaries when it needs fewer matrix
+        # products than the Taylor series (the linear solve counts as 4/3 product)
+
+        # matrix products to evaluate the Pade approximants of each order
+        self.pade_products = {3: 2, 5: 3, 7: 4, 9: 5, 13: 6}
+
+        if self.exp_method == 'auto':
+            self.exp_method = 'taylor'
+            if not (self.state_transfer or self.use_sparse or self.Taylor_terms is not None):
+                self.pade_order, self.pade_scaling = self.get_cached(
+                    'pade_terms', self.Choose_pade_terms)
+                pade_cost = self.pade_products[self.pade_order] + \
+                    4./3 + self.pade_scaling
+                taylor_cost = self.exp_terms - 1 + self.scaling
+                if pade_cost < taylor_cost:
+                    self.exp_method = 'pade'
+        elif self.exp_method == 'pade':
+            self.pade_order, self.pade_scaling = self.get_cached(
+                'pade_terms', self.Choose_pade_terms)
+
+        if self.exp_method == 'pade':
+            if self.save:
+                with H5File(self.file_path, 'a') as hf:
+                    hf.add('pade_order', data=self.pade_order)
+                    hf.add('pade_scaling', data=self.pade_scaling)
+
+            print("Using Pade [" + str(self.pade_order) + "/" + str(self.pade_order) + "] approximants and " +
+                  str(self.pade_scaling)+" Scaling & Squaring terms")
+
+    def init_save_policy(self, save_policy):
+        # what is saved, and how: the default is every dataset at every save, compressed in float64
+        self.save_policy = {'precision': 'float64', 'compression': 'gzip', 'history_step': 1, 'uks': 'all',
+                            'final_state': 'all', 'inter_vecs': 'all', 'inter_vecs_step': 1,
+                            'inter_vecs_keys': ['inter_vecs_raw_real', 'inter_vecs_raw_imag', 'inter_vecs_mag_squared',
+                                                'inter_vecs_real', 'inter_vecs_imag']}
+        if save_policy is None:
+            return
+
+        for key in save_policy:
+            if key not in self.save_policy:
+                raise ValueError(
+                    'save_policy should only include: %s. Got: %s' % (', '.join(self.save_policy), key))
+        if save_policy.get('precision', 'float64') not in ['float32', 'float64']:
+            raise ValueError(
+                'save_policy precision should be one of: float32, float64. Got: %s' % (save_policy['precision']))
+        if save_policy.get('compression', 'gzip') not in ['gzip', 'lzf', None]:
+            raise ValueError(
+                'save_policy compression should be one of: gzip, lzf, None. Got: %s' % (save_policy['compression']))
+        for key in ['history_step', 'inter_vecs_step']:
+            if save_policy.get(key, 1) < 1:
+                raise ValueError(
+                    'save_policy %s should be a positive integer. Got: %s' % (key, save_policy[key]))
+        for key in ['uks', 'final_state']:
+            if save_policy.get(key, 'all') not in ['all', 'final']:
+                raise ValueError(
+                    'save_policy %s should be one of: all, final. Got: %s' % (key, save_policy[key]))
+        if save_policy.get('inter_vecs', 'all') not in ['all', 'final', 'none']:
+            raise ValueError(
+                'save_policy inter_vecs should be one of: all, final, none. Got: %s' % (save_policy['inter_vecs']))
+        for key in save_policy.get('inter_vecs_keys', []):
+            if key not in self.save_policy['inter_vecs_keys']:
+                raise ValueError(
+                    'save_policy inter_vecs_keys should only include: %s. Got: %s' % (', '.join(self.save_policy['inter_vecs_keys']), key))
+
+        self.save_policy.update(save_policy)
 
     def init_system(self):
         self.dt = float(self.total_time)/self.steps
         self.state_num = len(self.H0_c)
+        # size of the propagated states, doubled by the real representation of complex numbers
+        if self.use_complex:
+            self.state_dim = self.state_num
+        else:
+            self.state_dim = 2*self.state_num
 
     def init_vectors(self):
         # initialized vectors used for propagation
@@ -183,7 +455,7 @@ class SystemParameters:
                     self.initial_vector_c[state] = 1
 
             self.initial_vectors_c.append(self.initial_vector_c)
-            self.initial_vector = c_to_r_vec(self.initial_vector_c)
+            self.initial_vector = self.to_state_vec(self.initial_vector_c)
 
             self.initial_vectors.append(self.initial_vector)
 
@@ -192,40 +464,64 @@ class SystemParameters:
                 hf.add('initial_vectors_c', data=np.array(
                     self.initial_vectors_c))
 
+    def init_operator_cache(self):
+        # the propagator settings and the operators only depend on these inputs: with an operator cache,
+        # they are loaded from a previous run with the same inputs when there is one
+        self.cached_operators = {}
+        self.operator_cache_changed = False
+        if self.operator_cache is None:
+            return
+
+        inputs = [self.H0_c, self.ops_c, self.ops_max_amp, self.dt, self.Unitary_error, self.steps, self.U0_c,
+                  self.state_transfer, self.no_scaling, self.use_complex, self.cache_graph]
+        if self.ensemble is not None:
+            # the terms are chosen for the variants
+            inputs = inputs + list(self.get_ensemble_variants())
+        self.operator_key = self.operator_cache.get_key(*inputs)
+        cached_operators = self.operator_cache.load(self.operator_key)
+        if cached_operators is not None:
+            self.cached_operators = cached_operators
+            print("Using the cached operators")
+
+    def get_cached(self, name, get_value):
+        # value of name from the operator cache, computed (and added to the cache) when it is missing
+        if name not in self.cached_operators:
+            self.cached_operators[name] = np.array(get_value())
+            self.operator_cache_changed = True
+
+        value = self.cached_operators[name]
+        if value.dtype.kind == 'i':
+            return [int(x) for x in value]
+
+        return value
+
+    def save_operator_cache(self):
+        if self.operator_cache is not None and self.operator_cache_changed:
+            self.operator_cache.save(self.operator_key, self.cached_operators)
+
+    def get_matrix_list(self):
+        # H0, the control operators (times -i dt) and the identity in the representation used for propagation
+        matrix_list = [self.to_state_mat(-1j*self.dt*self.H0_c)]
+        for op_c in self.ops_c:
+            matrix_list.append(self.to_state_mat(-1j*self.dt*op_c))
+        matrix_list.append(np.eye(self.state_dim))
+
+        return np.array(matrix_list)
+
     def init_operators(self):
         # Create operator matrix in numpy array
+        self.matrix_list = self.get_cached('matrix_list', self.get_matrix_list)
 
-        self.ops = []
-        for op_c in self.ops_c:
-            op = c_to_r_mat(-1j*self.dt*op_c)
-            self.ops.append(op)
-
+        self.H0 = self.matrix_list[0]
+        self.ops = list(self.matrix_list[1:-1])
         self.ops_len = len(self.ops)
 
-        self.H0 = c_to_r_mat(-1j*self.dt*self.H0_c)
         self.identity_c = np.identity(self.state_num)
-        self.identity = c_to_r_mat(self.identity_c)
+        self.identity = self.to_state_mat(self.identity_c)
 
         if self.Taylor_terms is None:
-            self.exps = []
-            self.scalings = []
-            if self.state_transfer or self.no_scaling:
-                comparisons = 1
-            else:
-                comparisons = 6
-            d = 0
-            while comparisons > 0:
-
-                self.exp_terms = self.Choose_exp_terms(d)
-                self.exps.append(self.exp_terms)
-                self.scalings.append(self.scaling)
-                comparisons = comparisons - 1
-                d = d+1
-            self.complexities = np.add(self.exps, self.scalings)
-            a = np.argmin(self.complexities)
-
-            self.exp_terms = self.exps[a]
-            self.scaling = self.scalings[a]
+            self.exp_terms, self.scaling = self.get_cached(
+                'exp_terms', self.Choose_exp_terms)
         else:
             self.exp_terms = self.Taylor_terms[0]
             self.scaling = self.Taylor_terms[1]
@@ -238,18 +534,81 @@ class SystemParameters:
         print("Using " + str(self.exp_terms) + " Taylor terms and " +
               str(self.scaling)+" Scaling & Squaring terms")
 
-        i_array = np.eye(2*self.state_num)
-        op_matrix_I = i_array.tolist()
+    def init_sparse(self):
+        # sparse Hamiltonians: H0 and the control operators are stored on the union of their
+        # nonzero patterns, sparse_indices, with one row of sparse_values per operator
+        input_num = self.ops_len + 1
+        pattern = np.any(self.matrix_list[0:input_num] != 0, axis=0)
+        self.sparse_indices = np.argwhere(pattern).astype(np.int64)
+        self.sparse_values = self.matrix_list[0:input_num][:,
+                                                           self.sparse_indices[:, 0], self.sparse_indices[:, 1]]
+        density = len(self.sparse_indices)/float(self.state_dim**2)
+
+        self.use_sparse = False
+        if self.sparse_H and density <= self.sparse_density:
+            if self.propagation in ['batched', 'tree'] or self.exact_gradient or self.exp_method == 'pade':
+                print("Sparse Hamiltonians are not used with " + self.propagation +
+                      " propagation, exact_gradient or Pade propagation, using dense Hamiltonians")
+            else:
+                self.use_sparse = True
+                print("Using sparse Hamiltonians with " + str(len(self.sparse_indices)) +
+                      " nonzero elements (density " + str(density) + ")")
+
+    def get_ensemble_variants(self):
+        # lists of the H0 and of the control Hamiltonians of the ensemble variants
+        if 'H0' in self.ensemble:
+            H0_list = list(self.ensemble['H0'])
+        else:
+            H0_list = [self.H0_c]*len(self.ensemble['Hops'])
+        if 'Hops' in self.ensemble:
+            Hops_list = list(self.ensemble['Hops'])
+        else:
+            Hops_list = [self.ops_c]*len(H0_list)
+        if len(H0_list) != len(Hops_list):
+            raise ValueError('ensemble H0 and Hops should have the same number of variants. Got: %d and %d' % (
+                len(H0_list), len(Hops_list)))
+        for ops_c in Hops_list:
+            if len(ops_c) != len(self.ops_c):
+                raise ValueError(
+                    'Each ensemble variant should have %d control Hamiltonians. Got: %d' % (len(self.ops_c), len(ops_c)))
+
+        return H0_list, Hops_list
+
+    def init_ensemble(self):
+        # Hamiltonian variants sharing the controls: ensemble_matrix_list is shaped as
+        # (variants, input_num, 2*state_num, 2*state_num), without the identity
+        H0_list, Hops_list = self.get_ensemble_variants()
+        self.ensemble_size = len(H0_list)
+
+        self.ensemble_matrix_list = []
+        for H0_c, ops_c in zip(H0_list, Hops_list):
+            self.ensemble_matrix_list.append([self.to_state_mat(-1j*self.dt*H0_c)] +
+                                             [self.to_state_mat(-1j*self.dt*op_c) for op_c in ops_c])
+        self.ensemble_matrix_list = np.array(self.ensemble_matrix_list)
+
+        if 'weights' in self.ensemble:
+            weights = np.array(self.ensemble['weights'], dtype=float)
+            if len(weights) != self.ensemble_size or np.any(weights < 0) or np.sum(weights) <= 0:
+                raise ValueError(
+                    'ensemble weights should be %d non negative numbers' % (self.ensemble_size))
+        else:
+            weights = np.ones(self.ensemble_size)
+        self.ensemble_weights = weights/np.sum(weights)
+        self.ensemble_loss = self.ensemble.get('loss', 'average')
+
+        print("Using an ensemble of " + str(self.ensemble_size) +
+              " Hamiltonians with the " + self.ensemble_loss + " loss")
 
-        self.H_ops = []
-        for op in self.ops:
-            self.H_ops.append(op)
-        self.matrix_list = [self.H0]
-        for ii in range(self.ops_len):
-            self.matrix_list = self.matrix_list + [self.H_ops[ii]]
-        self.matrix_list = self.matrix_list + [op_matrix_I]
+    def init_krylov(self):
+        # Krylov subspace propagation: the error of each step is bounded by Unitary_error/steps,
+        # with a subspace dimension up to krylov_dim
+        if self.krylov_dim is None:
+            self.krylov_dim = min(self.state_dim, 30)
+        self.krylov_dim = min(self.krylov_dim, self.state_dim)
+        self.krylov_tol = self.Unitary_error/self.steps
 
-        self.matrix_list = np.array(self.matrix_list)
+        print("Using Krylov subspaces of dimension up to " +
+              str(self.krylov_dim) + " with error per step below " + str(self.krylov_tol))
 
     def init_one_minus_gaussian_envelope(self):
         # Generating the Gaussian envelope that pulses should obey
@@ -284,4 +643,35 @@ class SystemParameters:
             self.ops_weight_base = np.random.normal(
                 initial_mean, initial_stddev, [self.ops_len, self.steps])
 
+        if self.num_starts > 1:
+            # the first start is the initial guess (or random), the others are random
+            initial_stddev = (1./np.sqrt(self.steps))
+            self.ops_weight_base = np.concatenate([[self.ops_weight_base], np.random.normal(
+                0, initial_stddev, [self.num_starts-1, self.ops_len, self.steps])], 0)
+
         self.raw_shape = np.shape(self.ops_weight_base)
+
+    def get_graph_key(self):
+        # everything the tensorflow graph depends on, other than the system variables (Hamiltonians,
+        # initial and target states, amplitudes and initial pulses): systems with the same key share a graph
+        key = (self.state_dim, self.use_complex, self.precision, self.ops_len, self.steps, len(self.states_concerned_list),
+               self.state_transfer, self.exp_terms, self.scaling, self.propagation, self.exact_gradient, self.checkpoints,
+               self.exp_method, self.krylov_dim, self.use_inter_vecs, self.num_starts, self.use_gpu, self.num_threads,
+               self.sparse_H, self.sparse_U, self.sparse_K, self.use_sparse, self.second_order, self.lbfgs, repr(sorted(self.reg_coeffs.items())))
+
+        if self.exp_method == 'krylov':
+            key = key + (self.krylov_tol,)
+        if self.exp_method == 'pade':
+            key = key + (self.pade_order, self.pade_scaling)
+        if self.use_sparse:
+            key = key + (self.sparse_indices.tobytes(),)
+        if self.ensemble is not None:
+            key = key + (self.ensemble_size, self.ensemble_loss,
+                         tuple(self.ensemble_weights))
+        if any([reg in self.reg_coeffs for reg in ['dwdt', 'd2wdt2', 'bandpass']]):
+            # the time derivatives and the frequencies of the pulses
+            key = key + (self.dt, self.total_time)
+        if self.is_dressed and 'forbidden_coeff_list' in self.reg_coeffs:
+            key = key + (np.array(self.v_c).tobytes(), repr(self.dressed_id))
+
+        return key
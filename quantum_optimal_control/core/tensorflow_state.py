@@ -9,36 +9,295 @@ from tensorflow.python.framework import function
 from tensorflow.python.framework import ops
 
 
+class StartState:
+    # the tensors of one start (or ensemble variant), with the other attributes of the TensorflowState, for get_reg_loss
+
+    def __init__(self, tfs, **tensors):
+        self.tfs = tfs
+        self.__dict__.update(tensors)
+
+    def __getattr__(self, name):
+        return getattr(self.tfs, name)
+
+
 class TensorflowState:
 
     def __init__(self, sys_para):
 
         self.sys_para = sys_para
 
+        # propagation is in float64 in double precision, float32 otherwise
+        if self.sys_para.precision == 'float64':
+            self.real_dtype = tf.float64
+        else:
+            self.real_dtype = tf.float32
+
+        # the final overlap and the loss are accumulated in float64 in double and mixed precision
+        if self.sys_para.precision == 'float32':
+            self.loss_dtype = tf.float32
+        else:
+            self.loss_dtype = tf.float64
+
+        # operators and states are complex with native complex arithmetic, real (double size) otherwise
+        complex_dtypes = {tf.float32: tf.complex64, tf.float64: tf.complex128}
+        if self.sys_para.use_complex:
+            self.state_dtype = complex_dtypes[self.real_dtype]
+            self.overlap_dtype = complex_dtypes[self.loss_dtype]
+        else:
+            self.state_dtype = self.real_dtype
+            self.overlap_dtype = self.loss_dtype
+
+        # the assign ops and placeholders of the variables holding the system, with the functions
+        # of sys_para giving their values
+        self.system_variables = []
+        self.tf_system_matrix_list = None
+        self.tf_system_ensemble_list = None
+
+    def get_system_variable(self, get_value, dtype, name=None):
+        # a tensor of the system (Hamiltonians, initial and target states, amplitudes) kept in a variable,
+        # so that another system with the same graph_key is loaded without rebuilding the graph
+        variable = tf.Variable(get_value(self.sys_para),
+                               dtype=dtype, trainable=False, name=name)
+        self.init_system_input(variable, get_value)
+
+        return variable
+
+    def init_system_input(self, variable, get_value):
+        # placeholder and assign op loading get_value(sys_para) into variable, built with the graph
+        placeholder = tf.placeholder(
+            variable.dtype.base_dtype, shape=variable.get_shape())
+        assign = variable.assign(placeholder)
+        self.system_variables.append((assign, placeholder, get_value))
+
+        return placeholder, assign
+
+    def load_system(self, session, sys_para):
+        # use the graph for sys_para: loads its system and initial pulses into the (initialized) variables
+        self.sys_para = sys_para
+        session.run([assign for assign, _, _ in self.system_variables],
+                    feed_dict=dict([(placeholder, get_value(sys_para)) for _, placeholder, get_value in self.system_variables]))
+
+    def get_tf_matrix_list(self):
+        # H0, the control operators and the identity, or their nonzero values with sparse Hamiltonians
+        if self.tf_system_matrix_list is None:
+            if self.sys_para.use_sparse:
+                self.tf_system_matrix_list = self.get_system_variable(
+                    lambda sys_para: sys_para.sparse_values, self.state_dtype, name='matrix_list')
+            else:
+                self.tf_system_matrix_list = self.get_system_variable(
+                    lambda sys_para: sys_para.matrix_list, self.state_dtype, name='matrix_list')
+
+        return self.tf_system_matrix_list
+
+    def get_tf_ensemble_list(self):
+        # H0 and the control operators of all the ensemble variants
+        if self.tf_system_ensemble_list is None:
+            self.tf_system_ensemble_list = self.get_system_variable(
+                lambda sys_para: sys_para.ensemble_matrix_list, self.state_dtype, name='ensemble_list')
+
+        return self.tf_system_ensemble_list
+
+    def get_identity(self, H_all):
+        if self.sys_para.use_sparse:
+            return tf.eye(self.sys_para.state_dim, dtype=self.state_dtype)
+        else:
+            return H_all[len(self.sys_para.Hnames) + 1]
+
+    def get_hamiltonian(self, uks, H_all):
+        # Hamiltonian of one time step, sum over k of uks[k] H_k, a SparseTensor with sparse Hamiltonians
+        input_num = len(self.sys_para.Hnames) + 1
+        if self.sys_para.use_sparse:
+            values = tf.tensordot(
+                tf.cast(uks, self.state_dtype), H_all, axes=1)
+            return tf.SparseTensor(self.sys_para.sparse_indices, values,
+                                   [self.sys_para.state_dim, self.sys_para.state_dim])
+        else:
+            return tf.add_n([tf.cast(uks[ii], self.state_dtype)*H_all[ii] for ii in range(input_num)])
+
+    def hamiltonian_matmul(self, H, M, b_is_sparse=False):
+        # product of a Hamiltonian with a dense matrix
+        if self.sys_para.use_sparse:
+            return tf.sparse.sparse_dense_matmul(H, M)
+        else:
+            return tf.matmul(H, M, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=b_is_sparse)
+
+    def get_hamiltonian_grad(self, H_all, grad, M, b_is_sparse=False):
+        # sum(conj(grad) * (H_k M)) for the control operators, shaped as (input_num-1)
+        input_num = len(self.sys_para.Hnames) + 1
+        if self.sys_para.use_sparse:
+            # only the nonzero elements of H_k contribute: sum over j of conj(grad)_ij M_kj for each (i, k)
+            rows = self.sys_para.sparse_indices[:, 0]
+            cols = self.sys_para.sparse_indices[:, 1]
+            overlaps = tf.reduce_sum(tf.gather(tf.conj(grad), rows) *
+                                     tf.gather(M, cols), 1)
+            return tf.real(tf.tensordot(H_all[1:input_num], overlaps, axes=1))
+        else:
+            return tf.stack([tf.reduce_sum(tf.real(tf.multiply(tf.conj(grad),
+                                                               tf.matmul(H_all[ii], M, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=b_is_sparse))))
+                             for ii in range(1, input_num)])
+
     def init_defined_functions(self):
         # define propagation functions used for evolution
         input_num = len(self.sys_para.Hnames) + 1
         taylor_terms = self.sys_para.exp_terms
         scaling = self.sys_para.scaling
+        state_dtype = self.state_dtype
+        real_dtype = self.real_dtype
+        exact_gradient = self.sys_para.exact_gradient
+        use_pade = self.sys_para.exp_method == 'pade'
+        if use_pade:
+            pade_order = self.sys_para.pade_order
+            pade_scaling = self.sys_para.pade_scaling
+            # coefficients of the numerator p(H) of the Pade approximant, the denominator is p(-H)
+            pade_coeffs = [math.factorial(2*pade_order-ii)*math.factorial(pade_order) /
+                           (math.factorial(2*pade_order)*math.factorial(ii)*math.factorial(pade_order-ii))
+                           for ii in range(pade_order+1)]
+
+        def get_pade(H):
+            # Pade [m/m] approximant of exp(H), q(H)^-1 p(H) with p(H) = V + U and q(H) = V - U,
+            # V and U being the even and odd parts of the numerator
+            I = tf.eye(tf.shape(H)[-1], dtype=state_dtype)
+            b = pade_coeffs
+            H2 = tf.matmul(H, H)
+            if pade_order == 13:
+                # the terms above H^6 are factored by H^6
+                H4 = tf.matmul(H2, H2)
+                H6 = tf.matmul(H4, H2)
+                U = tf.matmul(H, tf.matmul(H6, b[13]*H6 + b[11]*H4 + b[9]*H2) +
+                              b[7]*H6 + b[5]*H4 + b[3]*H2 + b[1]*I)
+                V = tf.matmul(H6, b[12]*H6 + b[10]*H4 + b[8]*H2) + \
+                    b[6]*H6 + b[4]*H4 + b[2]*H2 + b[0]*I
+            else:
+                powers = [I, H2]
+                while len(powers) < (pade_order+1)//2:
+                    powers.append(tf.matmul(powers[-1], H2))
+                U = tf.matmul(H, sum([b[2*ii+1]*powers[ii]
+                                      for ii in range((pade_order+1)//2)]))
+                V = sum([b[2*ii]*powers[ii]
+                         for ii in range((pade_order+1)//2)])
+
+            return tf.linalg.solve(V - U, V + U)
+
+        def get_matexp_series(H, I):
+            # exp(H) with the Taylor series (or the Pade approximant) and scaling and squaring,
+            # for a batch of Hamiltonians shaped as (..., 2*state_num, 2*state_num)
+            if use_pade:
+                matexp = get_pade(H/(2.**pade_scaling))
+                squarings = pade_scaling
+            else:
+                H = H/(2.**scaling)
+                matexp = I + H
+                H_n = H
+                factorial = 1.
+
+                for ii in range(2, taylor_terms+1):
+                    factorial = factorial * ii
+                    H_n = tf.matmul(H, H_n)
+                    matexp = matexp + H_n/factorial
+                squarings = scaling
+
+            for ii in range(squarings):
+                matexp = tf.matmul(matexp, matexp)
+
+            return matexp
+
+        def get_matexp_adjoint_derivative(H, grad):
+            # exact gradient of the matrix exponential: the adjoint Frechet derivative L(H^dagger, grad)
+            # of the truncated Taylor series with scaling and squaring, which is the upper right block
+            # of the same series applied to the block matrix [[H^dagger, grad], [0, H^dagger]]
+            # H and grad are shaped as (..., 2*state_num, 2*state_num)
+            if use_pade:
+                return get_pade_adjoint_derivative(H, grad)
+
+            I = tf.eye(tf.shape(H)[-1], dtype=state_dtype)
+            H_adj = tf.linalg.adjoint(H)/(2.**scaling)
+            grad = grad/(2.**scaling)
+
+            # powers of the block matrix have H_adj^n on the diagonal and grad_n in the upper right
+            matexp = I + H_adj
+            frechet = grad
+            H_n = H_adj
+            grad_n = grad
+            factorial = 1.
+
+            for ii in range(2, taylor_terms+1):
+                factorial = factorial * ii
+                grad_n = tf.matmul(H_adj, grad_n) + tf.matmul(grad, H_n)
+                H_n = tf.matmul(H_adj, H_n)
+                matexp = matexp + H_n/factorial
+                frechet = frechet + grad_n/factorial
+
+            for ii in range(scaling):
+                frechet = tf.matmul(matexp, frechet) + \
+                    tf.matmul(frechet, matexp)
+                matexp = tf.matmul(matexp, matexp)
+
+            return frechet
+
+        def get_pade_adjoint_derivative(H, grad):
+            # same as get_matexp_adjoint_derivative for the Pade approximant, which is evaluated
+            # on the block matrix itself
+            dim = tf.shape(H)[-1]
+            H_adj = tf.linalg.adjoint(H)/(2.**pade_scaling)
+            grad = grad/(2.**pade_scaling)
+
+            block = tf.concat([tf.concat([H_adj, grad], -1),
+                               tf.concat([tf.zeros_like(H_adj), H_adj], -1)], -2)
+            block_exp = get_pade(block)
+            matexp = block_exp[..., :dim, :dim]
+            frechet = block_exp[..., :dim, dim:]
+
+            for ii in range(pade_scaling):
+                frechet = tf.matmul(matexp, frechet) + \
+                    tf.matmul(frechet, matexp)
+                matexp = tf.matmul(matexp, matexp)
+
+            return frechet
+
+        def get_matvecexp_adjoint_derivative(H, psi, grad):
+            # exact gradient of the Taylor series of the matrix vector exponential:
+            # sum over n of 1/n! sum over i+j = n-1 of (H^dagger)^i grad (H^j psi)^dagger
+            H_adj = tf.linalg.adjoint(H)
+
+            grad_list = [grad]
+            psi_list = [psi]
+            for ii in range(1, taylor_terms-1):
+                grad_list.append(tf.matmul(H_adj, grad_list[-1]))
+                psi_list.append(tf.matmul(H, psi_list[-1]))
+
+            factorials = [1.]
+            for ii in range(1, taylor_terms):
+                factorials.append(factorials[-1]*ii)
+
+            frechet = []
+            for ii in range(taylor_terms-1):
+                psi_sum = tf.add_n([psi_list[jj]/factorials[ii+jj+1]
+                                    for jj in range(taylor_terms-1-ii)])
+                frechet.append(
+                    tf.matmul(grad_list[ii], psi_sum, adjoint_b=True))
+
+            return tf.add_n(frechet)
 
         def get_matexp(uks, H_all):
             # matrix exponential
-            I = H_all[input_num]
-            matexp = I
-            uks_Hk_list = []
-            for ii in range(input_num):
-                uks_Hk_list.append((uks[ii]/(2.**scaling))*H_all[ii])
+            I = self.get_identity(H_all)
+            if use_pade:
+                return get_matexp_series(self.get_hamiltonian(uks, H_all), I)
 
-            H = tf.add_n(uks_Hk_list)
-            H_n = H
+            matexp = I
+            H = self.get_hamiltonian(uks/(2.**scaling), H_all)
+            if self.sys_para.use_sparse:
+                H_n = tf.sparse.to_dense(H)
+            else:
+                H_n = H
             factorial = 1.
 
             for ii in range(1, taylor_terms+1):
                 factorial = factorial * ii
                 matexp = matexp + H_n/factorial
                 if not ii == (taylor_terms):
-                    H_n = tf.matmul(
-                        H, H_n, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=self.sys_para.sparse_U)
+                    H_n = self.hamiltonian_matmul(
+                        H, H_n, b_is_sparse=self.sys_para.sparse_U)
 
             for ii in range(scaling):
                 matexp = tf.matmul(
@@ -46,120 +305,563 @@ class TensorflowState:
 
             return matexp
 
-        @function.Defun(tf.float32, tf.float32, tf.float32)
+        @function.Defun(real_dtype, state_dtype, state_dtype)
         def matexp_op_grad(uks, H_all, grad):
             # gradient of matrix exponential
             coeff_grad = []
 
-            coeff_grad.append(tf.constant(0, dtype=tf.float32))
+            coeff_grad.append(tf.constant(0, dtype=real_dtype))
+
+            if exact_gradient:
+                H = tf.add_n([tf.cast(uks[ii], state_dtype)*H_all[ii]
+                              for ii in range(input_num)])
+                frechet = get_matexp_adjoint_derivative(H, grad)
+
+                for ii in range(1, input_num):
+                    coeff_grad.append(tf.reduce_sum(
+                        tf.real(tf.multiply(tf.conj(frechet), H_all[ii]))))
+
+                return [tf.stack(coeff_grad), tf.zeros(tf.shape(H_all), dtype=state_dtype)]
 
             # get output of the function
             matexp = get_matexp(uks, H_all)
             ###
 
-            for ii in range(1, input_num):
-                coeff_grad.append(tf.reduce_sum(tf.multiply(grad,
-                                                            tf.matmul(H_all[ii], matexp, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=self.sys_para.sparse_U))))
+            coeff_grad = tf.concat([tf.stack(coeff_grad), self.get_hamiltonian_grad(
+                H_all, grad, matexp, b_is_sparse=self.sys_para.sparse_U)], 0)
 
-            return [tf.stack(coeff_grad), tf.zeros(tf.shape(H_all), dtype=tf.float32)]
+            return [coeff_grad, tf.zeros(tf.shape(H_all), dtype=state_dtype)]
 
         global matexp_op
 
-        @function.Defun(tf.float32, tf.float32, grad_func=matexp_op_grad)
+        @function.Defun(real_dtype, state_dtype, grad_func=matexp_op_grad)
         def matexp_op(uks, H_all):
             # matrix exponential defun operator
             matexp = get_matexp(uks, H_all)
 
             return matexp
 
-        def get_matvecexp(uks, H_all, psi):
-            # matrix vector exponential
+        def get_matexp_batch(H_weights, H_all):
+            # matrix exponentials of all time steps at once
+            # H_weights is shaped as (input_num, time_steps), the output as (time_steps, 2*state_num, 2*state_num)
             I = H_all[input_num]
-            matvecexp = psi
 
-            uks_Hk_list = []
+            # all the Hamiltonians in one contraction
+            H = tf.tensordot(tf.cast(tf.transpose(H_weights), state_dtype),
+                             H_all[0:input_num], axes=1)
+
+            return get_matexp_series(H, I)
+
+        @function.Defun(real_dtype, state_dtype, state_dtype)
+        def matexp_batch_op_grad(H_weights, H_all, grad):
+            # gradient of the batched matrix exponential, same approximation as matexp_op_grad
+            if exact_gradient:
+                H = tf.tensordot(tf.cast(tf.transpose(H_weights), state_dtype),
+                                 H_all[0:input_num], axes=1)
+                grad_matexp = tf.conj(
+                    get_matexp_adjoint_derivative(H, grad))
+            else:
+                matexp = get_matexp_batch(H_weights, H_all)
+
+                # sum(conj(grad) * (H_k K)) = sum(H_k * (conj(grad) K^T)) for every time step
+                grad_matexp = tf.matmul(
+                    tf.conj(grad), matexp, transpose_b=True)
+
+            coeff_grad = tf.real(tf.tensordot(
+                H_all[1:input_num], grad_matexp, axes=[[1, 2], [1, 2]]))
+            coeff_grad = tf.concat(
+                [tf.zeros([1, tf.shape(H_weights)[1]], dtype=real_dtype), coeff_grad], 0)
+
+            return [coeff_grad, tf.zeros(tf.shape(H_all), dtype=state_dtype)]
+
+        global matexp_batch_op
+
+        @function.Defun(real_dtype, state_dtype, grad_func=matexp_batch_op_grad)
+        def matexp_batch_op(H_weights, H_all):
+            # batched matrix exponential defun operator
+            matexp = get_matexp_batch(H_weights, H_all)
 
-            for ii in range(input_num):
-                uks_Hk_list.append(uks[ii]*H_all[ii])
+            return matexp
+
+        def get_ensemble_hamiltonians(H_weights, H_ens):
+            # Hamiltonians of all the variants and time steps in one contraction, the controls are shared
+            # H_ens is shaped as (variants, input_num, 2*state_num, 2*state_num),
+            # the output as (variants, time_steps, 2*state_num, 2*state_num)
+            H = tf.tensordot(H_ens, tf.cast(
+                H_weights, state_dtype), axes=[[1], [0]])
+            return tf.transpose(H, [0, 3, 1, 2])
+
+        def get_matexp_ensemble(H_weights, H_ens):
+            # matrix exponentials of all the variants and time steps at once
+            H = get_ensemble_hamiltonians(H_weights, H_ens)
+            I = tf.eye(tf.shape(H)[-1], dtype=state_dtype)
+
+            return get_matexp_series(H, I)
+
+        @function.Defun(real_dtype, state_dtype, state_dtype)
+        def matexp_ensemble_op_grad(H_weights, H_ens, grad):
+            # gradient of the ensemble matrix exponential, same approximation as matexp_op_grad
+            if exact_gradient:
+                grad_matexp = tf.conj(get_matexp_adjoint_derivative(
+                    get_ensemble_hamiltonians(H_weights, H_ens), grad))
+            else:
+                matexp = get_matexp_ensemble(H_weights, H_ens)
+                grad_matexp = tf.matmul(
+                    tf.conj(grad), matexp, transpose_b=True)
+
+            # the controls are shared, so the gradients of the variants add up
+            coeff_grad = tf.real(tf.einsum(
+                'ekij,etij->kt', H_ens[:, 1:input_num], grad_matexp))
+            coeff_grad = tf.concat(
+                [tf.zeros([1, tf.shape(H_weights)[1]], dtype=real_dtype), coeff_grad], 0)
+
+            return [coeff_grad, tf.zeros(tf.shape(H_ens), dtype=state_dtype)]
+
+        global matexp_ensemble_op
 
-            H = tf.add_n(uks_Hk_list)
+        @function.Defun(real_dtype, state_dtype, grad_func=matexp_ensemble_op_grad)
+        def matexp_ensemble_op(H_weights, H_ens):
+            # ensemble matrix exponential defun operator
+            matexp = get_matexp_ensemble(H_weights, H_ens)
+
+            return matexp
+
+        def get_matvecexp(uks, H_all, psi):
+            # matrix vector exponential
+            matvecexp = psi
+
+            H = self.get_hamiltonian(uks, H_all)
 
             psi_n = psi
             factorial = 1.
 
             for ii in range(1, taylor_terms):
                 factorial = factorial * ii
-                psi_n = tf.matmul(
-                    H, psi_n, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=self.sys_para.sparse_K)
+                psi_n = self.hamiltonian_matmul(
+                    H, psi_n, b_is_sparse=self.sys_para.sparse_K)
                 matvecexp = matvecexp + psi_n/factorial
 
             return matvecexp
 
-        @function.Defun(tf.float32, tf.float32, tf.float32, tf.float32)
+        @function.Defun(real_dtype, state_dtype, state_dtype, state_dtype)
         def matvecexp_op_grad(uks, H_all, psi, grad):
             # graident of matrix vector exponential
             coeff_grad = []
 
-            coeff_grad.append(tf.constant(0, dtype=tf.float32))
+            coeff_grad.append(tf.constant(0, dtype=real_dtype))
 
-            # get output of the function
-            matvecexp = get_matvecexp(uks, H_all, psi)
-            #####
+            if exact_gradient:
+                H = tf.add_n([tf.cast(uks[ii], state_dtype)*H_all[ii]
+                              for ii in range(input_num)])
+                frechet = get_matvecexp_adjoint_derivative(H, psi, grad)
 
-            for ii in range(1, input_num):
-                coeff_grad.append(tf.reduce_sum(tf.multiply(grad,
-                                                            tf.matmul(H_all[ii], matvecexp, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=self.sys_para.sparse_K))))
+                for ii in range(1, input_num):
+                    coeff_grad.append(tf.reduce_sum(
+                        tf.real(tf.multiply(tf.conj(frechet), H_all[ii]))))
+                coeff_grad = tf.stack(coeff_grad)
+            else:
+                # get output of the function
+                matvecexp = get_matvecexp(uks, H_all, psi)
+                #####
 
-            I = H_all[input_num]
-            vec_grad = grad
-            uks_Hk_list = []
-            for ii in range(input_num):
-                uks_Hk_list.append((-uks[ii])*H_all[ii])
+                coeff_grad = tf.concat([tf.stack(coeff_grad), self.get_hamiltonian_grad(
+                    H_all, grad, matvecexp, b_is_sparse=self.sys_para.sparse_K)], 0)
 
-            H = tf.add_n(uks_Hk_list)
+            vec_grad = grad
+            H = self.get_hamiltonian(-uks, H_all)
             vec_grad_n = grad
             factorial = 1.
 
             for ii in range(1, taylor_terms):
                 factorial = factorial * ii
-                vec_grad_n = tf.matmul(
-                    H, vec_grad_n, a_is_sparse=self.sys_para.sparse_H, b_is_sparse=self.sys_para.sparse_K)
+                vec_grad_n = self.hamiltonian_matmul(
+                    H, vec_grad_n, b_is_sparse=self.sys_para.sparse_K)
                 vec_grad = vec_grad + vec_grad_n/factorial
 
-            return [tf.stack(coeff_grad), tf.zeros(tf.shape(H_all), dtype=tf.float32), vec_grad]
+            return [coeff_grad, tf.zeros(tf.shape(H_all), dtype=state_dtype), vec_grad]
 
         global matvecexp_op
 
-        @function.Defun(tf.float32, tf.float32, tf.float32, grad_func=matvecexp_op_grad)
+        @function.Defun(real_dtype, state_dtype, state_dtype, grad_func=matvecexp_op_grad)
         def matvecexp_op(uks, H_all, psi):
             # matrix vector exponential defun operator
             matvecexp = get_matvecexp(uks, H_all, psi)
 
             return matvecexp
 
+        def get_matvecexp_batch(H, psi):
+            # matrix vector exponentials for a batch of Hamiltonians H, shaped as (num, 2*state_num, 2*state_num),
+            # and of vectors psi, shaped as (num, 2*state_num, number of vectors)
+            matvecexp = psi
+            psi_n = psi
+            factorial = 1.
+
+            for ii in range(1, taylor_terms):
+                factorial = factorial * ii
+                psi_n = tf.matmul(H, psi_n)
+                matvecexp = matvecexp + psi_n/factorial
+
+            return matvecexp
+
+        @function.Defun(state_dtype, state_dtype, state_dtype)
+        def matvecexp_batch_op_grad(H, psi, grad):
+            # gradient of the batched matrix vector exponential, same approximation as matvecexp_op_grad:
+            # the gradient with respect to the Hamiltonians, the controls get theirs by tensorflow
+            if exact_gradient:
+                grad_H = get_matvecexp_adjoint_derivative(H, psi, grad)
+            else:
+                grad_H = tf.matmul(
+                    grad, get_matvecexp_batch(H, psi), adjoint_b=True)
+
+            vec_grad = get_matvecexp_batch(tf.linalg.adjoint(H), grad)
+
+            return [grad_H, vec_grad]
+
+        global matvecexp_batch_op
+
+        @function.Defun(state_dtype, state_dtype, grad_func=matvecexp_batch_op_grad)
+        def matvecexp_batch_op(H, psi):
+            # batched matrix vector exponential defun operator
+            return get_matvecexp_batch(H, psi)
+
+        if self.sys_para.second_order:
+            # the gradients of the defun operators cannot be differentiated again: the propagation
+            # uses the series directly, whose gradient (by tensorflow) is exact
+            matexp_op = get_matexp
+            matexp_batch_op = get_matexp_batch
+            matexp_ensemble_op = get_matexp_ensemble
+            matvecexp_op = get_matvecexp
+            matvecexp_batch_op = get_matvecexp_batch
+
+        if self.sys_para.exp_method == 'krylov':
+            self.init_krylov_functions()
+
+        if self.sys_para.propagation == 'reverse':
+            self.init_reverse_functions(get_matexp, matexp_op_grad)
+
+    def init_krylov_functions(self):
+        # matrix vector exponential exp(H) psi in the Krylov subspace span{psi, H psi, ..., H^(m-1) psi},
+        # built by the Arnoldi iteration until the error estimate is below krylov_tol, up to krylov_dim
+        input_num = len(self.sys_para.Hnames) + 1
+        state_dtype = self.state_dtype
+        real_dtype = self.real_dtype
+        krylov_dim = self.sys_para.krylov_dim
+        krylov_tol = self.sys_para.krylov_tol
+        state_dim = self.sys_para.state_dim
+        vecs_num = len(self.sys_para.initial_vectors)
+        matrix_list_shape = self.get_tf_matrix_list().get_shape().as_list()
+
+        def get_norm(psi):
+            # norm of each vector (column)
+            return tf.sqrt(tf.reduce_sum(tf.real(tf.conj(psi)*psi), 0))
+
+        def get_hessenberg_expm(hessenberg, dim):
+            # exponential of the upper dim x dim block of the Hessenberg matrix, for each vector
+            # hessenberg is stored by columns, shaped as (max_dim, max_dim+1, number of vectors)
+            max_dim = hessenberg.get_shape().as_list()[0]
+            hessenberg = tf.transpose(hessenberg[:, 0:max_dim, :], [2, 1, 0])
+            in_block = tf.cast(tf.range(max_dim) < dim, state_dtype)
+            mask = tf.expand_dims(in_block, 1)*tf.expand_dims(in_block, 0)
+            return tf.linalg.expm(hessenberg*mask)
+
+        def get_krylov_expv(matmul, psi, max_dim, full_dim):
+            # exp(A) psi for the linear operator matmul(v) = A v of dimension full_dim, for each vector
+            # (column) of psi, in subspaces of dimension up to max_dim: when the error estimate is still
+            # above krylov_tol at max_dim (and the subspace is not the whole space), the run stops with
+            # an InvalidArgumentError rather than going on with an inaccurate propagation
+            vec_shape = psi.get_shape().as_list()
+
+            # a zero vector gives a zero basis, and a zero result
+            beta = get_norm(psi)
+            safe_beta = tf.where(beta > 1e-30, beta, tf.ones_like(beta))
+            basis = tf.concat([tf.expand_dims(psi/tf.cast(safe_beta, state_dtype), 0),
+                               tf.zeros([max_dim] + vec_shape, dtype=state_dtype)], 0)
+            hessenberg = tf.zeros(
+                [max_dim, max_dim+1, vec_shape[1]], dtype=state_dtype)
+
+            def arnoldi_step(jj, basis, hessenberg, error):
+                w = matmul(basis[jj])
+                # Gram-Schmidt against the basis, twice for numerical orthogonality
+                h = tf.zeros([max_dim+1, vec_shape[1]], dtype=state_dtype)
+                for _ in range(2):
+                    h_new = tf.einsum('kiv,iv->kv', tf.conj(basis), w)
+                    w = w - tf.einsum('kiv,kv->iv', basis, h_new)
+                    h = h + h_new
+
+                w_norm = get_norm(w)
+                h = h + tf.expand_dims(tf.one_hot(jj+1, max_dim+1, dtype=state_dtype), 1) * \
+                    tf.cast(w_norm, state_dtype)
+                hessenberg = tf.tensor_scatter_nd_update(
+                    hessenberg, [[jj]], [h])
+
+                # a vanishing w_norm means the subspace is invariant, and the error is zero
+                safe_norm = tf.where(w_norm > 1e-30, w_norm,
+                                     tf.ones_like(w_norm))
+                basis = tf.tensor_scatter_nd_update(
+                    basis, [[jj+1]], [w/tf.cast(safe_norm, state_dtype)])
+
+                # a posteriori error estimate: beta h_{m+1,m} |exp(H_m)_{m,1}|
+                expm = get_hessenberg_expm(hessenberg, jj+1)
+                error = tf.reduce_max(
+                    beta*w_norm*tf.abs(expm[:, jj, 0]))
+
+                return jj+1, basis, hessenberg, error
+
+            dim, basis, hessenberg, error = tf.while_loop(lambda jj, basis, hessenberg, error: tf.logical_and(jj < max_dim, error > krylov_tol),
+                                                          arnoldi_step, [tf.constant(0), basis, hessenberg, tf.constant(np.inf, dtype=real_dtype)])
+
+            converged = tf.debugging.Assert(tf.logical_or(error <= krylov_tol, dim >= full_dim),
+                                            ['The Krylov error estimate', error, 'is above the error per step', krylov_tol,
+                                             'with subspaces of dimension %d: increase krylov_dim' % (krylov_dim)])
+            with tf.control_dependencies([converged]):
+                expm = get_hessenberg_expm(hessenberg, dim)
+            coeffs = tf.cast(tf.expand_dims(beta, 1), state_dtype)*expm[:, :, 0]
+            return tf.einsum('kiv,vk->iv', basis[0:max_dim], coeffs)
+
+        def get_krylov_matvecexp(uks, H_all, psi):
+            H_all.set_shape(matrix_list_shape)
+            psi.set_shape([state_dim, vecs_num])
+            H = self.get_hamiltonian(uks, H_all)
+
+            return get_krylov_expv(lambda v: self.hamiltonian_matmul(H, v), psi, krylov_dim, state_dim)
+
+        def get_krylov_matvecexp_derivatives(uks, H_all, psi):
+            # derivatives of exp(H) psi along the control operators H_k (Frechet derivative): the upper
+            # half of exp([[H, H_k], [0, H]]) [0; psi], for all k at once with the vectors of H_k in
+            # the columns k*vecs_num to (k+1)*vecs_num. The block operator has twice the dimension,
+            # and its subspaces go up to 2*krylov_dim
+            H_all.set_shape(matrix_list_shape)
+            psi.set_shape([state_dim, vecs_num])
+            H = self.get_hamiltonian(uks, H_all)
+            H_ops = []
+            for ii in range(1, input_num):
+                if self.sys_para.use_sparse:
+                    H_ops.append(self.get_hamiltonian(
+                        tf.one_hot(ii, input_num, dtype=real_dtype), H_all))
+                else:
+                    H_ops.append(H_all[ii])
+
+            def block_matmul(v):
+                upper = self.hamiltonian_matmul(H, v[0:state_dim])
+                lower = v[state_dim:]
+                upper = upper + tf.concat([self.hamiltonian_matmul(H_ops[ii], lower[:, ii*vecs_num:(ii+1)*vecs_num])
+                                           for ii in range(input_num-1)], 1)
+                return tf.concat([upper, self.hamiltonian_matmul(H, lower)], 0)
+
+            block_psi = tf.concat([tf.zeros([state_dim, (input_num-1)*vecs_num], dtype=state_dtype),
+                                   tf.tile(psi, [1, input_num-1])], 0)
+            return get_krylov_expv(block_matmul, block_psi, min(2*krylov_dim, 2*state_dim), 2*state_dim)[0:state_dim]
+
+        @function.Defun(real_dtype, state_dtype, state_dtype, state_dtype)
+        def krylov_matvecexp_op_grad(uks, H_all, psi, grad):
+            # gradient of the Krylov matrix vector exponential: exact with exact_gradient, else the same
+            # first order approximation as matvecexp_op_grad
+            coeff_grad = []
+
+            coeff_grad.append(tf.constant(0, dtype=real_dtype))
+
+            if self.sys_para.exact_gradient:
+                derivatives = get_krylov_matvecexp_derivatives(
+                    uks, H_all, psi)
+                control_grad = tf.reduce_sum(tf.reshape(tf.real(tf.conj(tf.tile(grad, [1, input_num-1]))*derivatives),
+                                                        [state_dim, input_num-1, vecs_num]), [0, 2])
+            else:
+                matvecexp = get_krylov_matvecexp(uks, H_all, psi)
+                control_grad = self.get_hamiltonian_grad(
+                    H_all, grad, matvecexp)
+
+            coeff_grad = tf.concat([tf.stack(coeff_grad), control_grad], 0)
+
+            # exp(H)^dagger grad = exp(-H) grad for anti-hermitian H
+            vec_grad = get_krylov_matvecexp(-uks, H_all, grad)
+
+            return [coeff_grad, tf.zeros(tf.shape(H_all), dtype=state_dtype), vec_grad]
+
+        global krylov_matvecexp_op
+
+        @function.Defun(real_dtype, state_dtype, state_dtype, grad_func=krylov_matvecexp_op_grad)
+        def krylov_matvecexp_op(uks, H_all, psi):
+            # Krylov matrix vector exponential defun operator
+            return get_krylov_matvecexp(uks, H_all, psi)
+
+    def get_matvecexp_op(self):
+        # operator used for the state transfer propagation
+        if self.sys_para.exp_method == 'krylov':
+            return krylov_matvecexp_op
+        else:
+            return matvecexp_op
+
+    def init_reverse_functions(self, get_matexp, matexp_op_grad):
+        # propagation over all time steps in one defun operator, which does not keep the intermediate
+        # unitaries for the gradient: they are recomputed walking back from the final unitary with
+        # the inverse (adjoint) propagators, or from checkpoints every segment_len steps
+        steps = self.sys_para.steps
+        state_dtype = self.state_dtype
+        real_dtype = self.real_dtype
+        use_inter_vecs = self.sys_para.use_inter_vecs
+        checkpoints = self.sys_para.checkpoints
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+        vecs_shape = [self.sys_para.state_dim,
+                      len(self.sys_para.initial_vectors)]
+        matrix_list_shape = self.get_tf_matrix_list().get_shape().as_list()
+
+        def set_shapes(H_weights, H_all, U0, psi0):
+            # the defun inputs have unknown shapes, the while loops need them
+            H_weights.set_shape([len(self.sys_para.Hnames) + 1, steps])
+            H_all.set_shape(matrix_list_shape)
+            U0.set_shape(state_shape)
+            psi0.set_shape(vecs_shape)
+
+        def propagate(ii, H_weights, H_all, inter_state):
+            return tf.matmul(get_matexp(H_weights[:, ii], H_all), inter_state)
+
+        def get_final_state(H_weights, H_all, U0):
+            _, final_state = tf.while_loop(lambda ii, U: ii < steps,
+                                           lambda ii, U: (
+                                               ii+1, propagate(ii, H_weights, H_all, U)),
+                                           [tf.constant(0), U0])
+            return final_state
+
+        def get_final_state_and_vecs(H_weights, H_all, U0, psi0):
+            # inter vectors shaped as (time_steps, 2*state_num, number of vectors)
+            def body(ii, U, inter_vecs):
+                U = propagate(ii, H_weights, H_all, U)
+                return ii+1, U, inter_vecs.write(ii, tf.matmul(U, psi0))
+
+            _, final_state, inter_vecs = tf.while_loop(lambda ii, U, inter_vecs: ii < steps, body,
+                                                       [tf.constant(0), U0, tf.TensorArray(state_dtype, size=steps)])
+            return final_state, inter_vecs.stack()
+
+        def backward_step(ii, H_weights, H_all, propagator, prev_state, grad, coeff_grads):
+            # grad is the gradient with respect to the unitary after step ii
+            grad_propagator = tf.matmul(grad, prev_state, adjoint_b=True)
+            coeff_grads = coeff_grads.write(
+                ii, matexp_op_grad(H_weights[:, ii], H_all, grad_propagator)[0])
+            grad = tf.matmul(propagator, grad, adjoint_a=True)
+            return grad, coeff_grads
+
+        def get_reverse_grad(H_weights, H_all, U0, psi0, grad_final, grad_vecs):
+            # walk back from the final unitary: U_{ii-1} = K_ii^dagger U_ii, exact for unitary propagators
+            def body(ii, U, grad, coeff_grads):
+                propagator = get_matexp(H_weights[:, ii], H_all)
+                prev_state = tf.matmul(propagator, U, adjoint_a=True)
+                if grad_vecs is not None:
+                    grad = grad + tf.matmul(grad_vecs[ii], psi0, adjoint_b=True)
+                grad, coeff_grads = backward_step(
+                    ii, H_weights, H_all, propagator, prev_state, grad, coeff_grads)
+                return ii-1, prev_state, grad, coeff_grads
+
+            _, _, _, coeff_grads = tf.while_loop(lambda ii, U, grad, coeff_grads: ii >= 0, body,
+                                                 [tf.constant(steps-1), get_final_state(H_weights, H_all, U0), grad_final,
+                                                  tf.TensorArray(real_dtype, size=steps)])
+            return coeff_grads
+
+        def get_checkpoint_grad(H_weights, H_all, U0, psi0, grad_final, grad_vecs):
+            # keep the unitaries at the start of every segment, then recompute one segment at a time
+            segment_len = int(np.ceil(float(steps)/checkpoints))
+            segments = int(np.ceil(float(steps)/segment_len))
+
+            def forward_segment(start, U, states, propagators):
+                # propagate through one segment, keeping the unitaries before each step and the propagators
+                def body(ii, U, states, propagators):
+                    propagator = get_matexp(H_weights[:, ii], H_all)
+                    states = states.write(ii-start, U)
+                    propagators = propagators.write(ii-start, propagator)
+                    return ii+1, tf.matmul(propagator, U), states, propagators
+
+                return tf.while_loop(lambda ii, U, states, propagators: ii < tf.minimum(start+segment_len, steps), body,
+                                     [start, U, states, propagators])
+
+            def checkpoint_body(jj, U, checkpoint_states):
+                checkpoint_states = checkpoint_states.write(jj, U)
+                _, U, _, _ = forward_segment(jj*segment_len, U, tf.TensorArray(state_dtype, size=segment_len),
+                                             tf.TensorArray(state_dtype, size=segment_len))
+                return jj+1, U, checkpoint_states
+
+            _, _, checkpoint_states = tf.while_loop(lambda jj, U, checkpoint_states: jj < segments, checkpoint_body,
+                                                    [tf.constant(0), U0, tf.TensorArray(state_dtype, size=segments)])
+
+            def segment_body(jj, grad, coeff_grads):
+                start = jj*segment_len
+                _, _, states, propagators = forward_segment(start, checkpoint_states.read(jj),
+                                                            tf.TensorArray(
+                                                                state_dtype, size=segment_len),
+                                                            tf.TensorArray(state_dtype, size=segment_len))
+
+                def body(ii, grad, coeff_grads):
+                    if grad_vecs is not None:
+                        grad = grad + \
+                            tf.matmul(grad_vecs[ii], psi0, adjoint_b=True)
+                    grad, coeff_grads = backward_step(ii, H_weights, H_all, propagators.read(ii-start),
+                                                      states.read(ii-start), grad, coeff_grads)
+                    return ii-1, grad, coeff_grads
+
+                _, grad, coeff_grads = tf.while_loop(lambda ii, grad, coeff_grads: ii >= start, body,
+                                                     [tf.minimum(start+segment_len, steps)-1, grad, coeff_grads])
+                return jj-1, grad, coeff_grads
+
+            _, _, coeff_grads = tf.while_loop(lambda jj, grad, coeff_grads: jj >= 0, segment_body,
+                                              [tf.constant(segments-1), grad_final, tf.TensorArray(real_dtype, size=steps)])
+            return coeff_grads
+
+        def get_propagate_grad(H_weights, H_all, U0, psi0, grad_final, grad_vecs=None):
+            set_shapes(H_weights, H_all, U0, psi0)
+            grad_final.set_shape(state_shape)
+            if grad_vecs is not None:
+                grad_vecs.set_shape([steps] + vecs_shape)
+            if checkpoints is None:
+                coeff_grads = get_reverse_grad(
+                    H_weights, H_all, U0, psi0, grad_final, grad_vecs)
+            else:
+                coeff_grads = get_checkpoint_grad(
+                    H_weights, H_all, U0, psi0, grad_final, grad_vecs)
+
+            return [tf.transpose(coeff_grads.stack()), tf.zeros(tf.shape(H_all), dtype=state_dtype),
+                    tf.zeros(tf.shape(U0), dtype=state_dtype), tf.zeros(tf.shape(psi0), dtype=state_dtype)]
+
+        global propagate_reverse_op
+
+        if use_inter_vecs:
+            @function.Defun(real_dtype, state_dtype, state_dtype, state_dtype, state_dtype, state_dtype)
+            def propagate_reverse_op_grad(H_weights, H_all, U0, psi0, grad_final, grad_vecs):
+                return get_propagate_grad(H_weights, H_all, U0, psi0, grad_final, grad_vecs)
+
+            @function.Defun(real_dtype, state_dtype, state_dtype, state_dtype, grad_func=propagate_reverse_op_grad)
+            def propagate_reverse_op(H_weights, H_all, U0, psi0):
+                # final unitary, and the inter vectors of all time steps
+                set_shapes(H_weights, H_all, U0, psi0)
+                return get_final_state_and_vecs(H_weights, H_all, U0, psi0)
+        else:
+            @function.Defun(real_dtype, state_dtype, state_dtype, state_dtype, state_dtype)
+            def propagate_reverse_op_grad(H_weights, H_all, U0, psi0, grad_final):
+                return get_propagate_grad(H_weights, H_all, U0, psi0, grad_final)
+
+            @function.Defun(real_dtype, state_dtype, state_dtype, state_dtype, grad_func=propagate_reverse_op_grad)
+            def propagate_reverse_op(H_weights, H_all, U0, psi0):
+                # final unitary only
+                set_shapes(H_weights, H_all, U0, psi0)
+                return get_final_state(H_weights, H_all, U0)
+
     def init_variables(self):
         self.tf_one_minus_gaussian_envelope = tf.constant(
-            self.sys_para.one_minus_gauss, dtype=tf.float32, name='Gaussian')
+            self.sys_para.one_minus_gauss, dtype=self.real_dtype, name='Gaussian')
 
     def init_tf_vectors(self):
 
-        self.tf_initial_vectors = []
-        for initial_vector in self.sys_para.initial_vectors:
-            tf_initial_vector = tf.constant(initial_vector, dtype=tf.float32)
-            self.tf_initial_vectors.append(tf_initial_vector)
-        self.packed_initial_vectors = tf.transpose(
-            tf.stack(self.tf_initial_vectors))
+        self.tf_initial_vectors = self.get_system_variable(
+            lambda sys_para: np.array(sys_para.initial_vectors), self.state_dtype, name='initial_vectors')
+        self.packed_initial_vectors = tf.transpose(self.tf_initial_vectors)
 
     def init_tf_propagators(self):
         # tf initial and target propagator
         if self.sys_para.state_transfer:
-            self.target_vecs = tf.transpose(tf.constant(
-                np.array(self.sys_para.target_vectors), dtype=tf.float32))
+            self.target_vecs = tf.transpose(self.get_system_variable(
+                lambda sys_para: np.array(sys_para.target_vectors), self.state_dtype, name='target_vectors'))
         else:
-            self.tf_initial_unitary = tf.constant(
-                self.sys_para.initial_unitary, dtype=tf.float32, name='U0')
-            self.tf_target_state = tf.constant(
-                self.sys_para.target_unitary, dtype=tf.float32)
+            self.tf_initial_unitary = self.get_system_variable(
+                lambda sys_para: sys_para.initial_unitary, self.state_dtype, name='U0')
+            self.tf_target_state = self.get_system_variable(
+                lambda sys_para: sys_para.target_unitary, self.state_dtype, name='U')
             self.target_vecs = tf.matmul(
                 self.tf_target_state, self.packed_initial_vectors)
         print("Propagators initialized.")
@@ -170,18 +872,41 @@ class TensorflowState:
 
         # Just a vector of ones needed for the kernel
         self.H0_weight = tf.Variable(
-            tf.ones([self.sys_para.steps]), trainable=False)
+            tf.ones([self.sys_para.steps], dtype=self.real_dtype), trainable=False)
         # will collect all weights here
         self.weights_unpacked = [self.H0_weight]
         self.ops_weight_base = tf.Variable(tf.constant(
-            self.sys_para.ops_weight_base, dtype=tf.float32), dtype=tf.float32, name="weights_base")
-
-        self.ops_weight = tf.sin(self.ops_weight_base, name="weights")
+            self.sys_para.ops_weight_base, dtype=self.real_dtype), dtype=self.real_dtype, name="weights_base")
+        self.ops_weight_base_input, self.assign_ops_weight_base = self.init_system_input(
+            self.ops_weight_base, lambda sys_para: sys_para.ops_weight_base)
+        # the weights can also be fed directly (by the scipy optimizers), without assigning the variable
+        self.ops_weight_base_feed = tf.placeholder_with_default(
+            self.ops_weight_base, self.sys_para.raw_shape)
+        self.tf_ops_max_amp = self.get_system_variable(
+            lambda sys_para: np.array(sys_para.ops_max_amp, dtype=float), self.real_dtype, name='max_amp')
+
+        if self.sys_para.num_starts > 1:
+            # weights of all starts, shaped as (num_starts, ops_len, time_steps) and (num_starts, input_num, time_steps)
+            self.ops_weights = tf.sin(
+                self.ops_weight_base_feed, name="weights")
+            H0_weights = tf.ones(
+                [self.sys_para.num_starts, 1, self.sys_para.steps], dtype=self.real_dtype)
+            self.H_weights = tf.concat([H0_weights, tf.reshape(self.tf_ops_max_amp, [1, -1, 1]) *
+                                        self.ops_weights], 1, name="packed_weights")
+
+            # starts still optimized, the others are retired and not propagated anymore
+            self.start_active = tf.Variable(
+                tf.ones([self.sys_para.num_starts], dtype=self.loss_dtype), trainable=False)
+            self.active_starts = tf.where(self.start_active > 0)[:, 0]
+
+            print("Operators weight initialized.")
+            return
+
+        self.ops_weight = tf.sin(self.ops_weight_base_feed, name="weights")
         for ii in range(self.sys_para.ops_len):
             self.weights_unpacked.append(
-                self.sys_para.ops_max_amp[ii]*self.ops_weight[ii, :])
+                self.tf_ops_max_amp[ii]*self.ops_weight[ii, :])
 
-        # print len(self.sys_para.ops_max_amp)
         self.H_weights = tf.stack(self.weights_unpacked, name="packed_weights")
 
         print("Operators weight initialized.")
@@ -190,8 +915,8 @@ class TensorflowState:
         # initialize intermediate unitaries
         self.inter_states = []
         for ii in range(self.sys_para.steps):
-            self.inter_states.append(tf.zeros([2*self.sys_para.state_num, 2*self.sys_para.state_num],
-                                              dtype=tf.float32, name="inter_state_"+str(ii)))
+            self.inter_states.append(tf.zeros([self.sys_para.state_dim, self.sys_para.state_dim],
+                                              dtype=self.state_dtype, name="inter_state_"+str(ii)))
         print("Intermediate propagation variables initialized.")
 
     def get_inter_state_op(self, layer):
@@ -203,8 +928,7 @@ class TensorflowState:
         return propagator
 
     def init_tf_propagator(self):
-        self.tf_matrix_list = tf.constant(
-            self.sys_para.matrix_list, dtype=tf.float32)
+        self.tf_matrix_list = self.get_tf_matrix_list()
 
         # build propagator for all the intermediate states
 
@@ -223,8 +947,266 @@ class TensorflowState:
 
         self.final_state = self.inter_states[self.sys_para.steps-1]
 
-        self.unitary_scale = (0.5/self.sys_para.state_num)*tf.reduce_sum(
-            tf.matmul(tf.transpose(self.final_state), self.final_state))
+        self.unitary_scale = self.get_unitary_scale(self.final_state)
+
+        print("Intermediate propagators initialized.")
+
+    def get_unitary_scale(self, final_state):
+        # overlap of the final unitary with itself, one for a unitary evolution
+        if self.sys_para.use_complex:
+            return (1.0/self.sys_para.state_num)*tf.reduce_sum(
+                tf.real(tf.matmul(final_state, final_state, adjoint_a=True)))
+        else:
+            return (0.5/self.sys_para.state_num)*tf.reduce_sum(
+                tf.matmul(tf.transpose(final_state), final_state))
+
+    def init_tf_propagator_scan(self):
+        # same propagation as init_tf_propagator, but looped over the time steps with tf.scan,
+        # so the graph size does not grow with the number of steps
+        self.tf_matrix_list = self.get_tf_matrix_list()
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+
+        def propagate(inter_state, uks):
+            propagator = matexp_op(uks, self.tf_matrix_list)
+            propagator.set_shape(state_shape)
+            return tf.matmul(propagator, inter_state, a_is_sparse=self.sys_para.sparse_U,
+                             b_is_sparse=self.sys_para.sparse_K)
+
+        # inter_states_packed is shaped as (time_steps, 2*state_num, 2*state_num)
+        self.inter_states_packed = tf.scan(propagate, tf.transpose(self.H_weights),
+                                           initializer=self.tf_initial_unitary, name="inter_states")
+
+        self.final_state = self.inter_states_packed[self.sys_para.steps-1]
+
+        self.unitary_scale = self.get_unitary_scale(self.final_state)
+
+        print("Intermediate propagators initialized.")
+
+    def init_tf_propagator_batch(self):
+        # propagators of all time steps computed by one batched matrix exponential,
+        # then multiplied together in a tf.scan
+        self.tf_matrix_list = self.get_tf_matrix_list()
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+
+        # shaped as (time_steps, 2*state_num, 2*state_num)
+        self.tf_inter_state_op = matexp_batch_op(
+            self.H_weights, self.tf_matrix_list)
+        self.tf_inter_state_op.set_shape([self.sys_para.steps] + state_shape)
+
+        def propagate(inter_state, propagator):
+            return tf.matmul(propagator, inter_state)
+
+        self.inter_states_packed = tf.scan(propagate, self.tf_inter_state_op,
+                                           initializer=self.tf_initial_unitary, name="inter_states")
+
+        self.final_state = self.inter_states_packed[self.sys_para.steps-1]
+
+        self.unitary_scale = self.get_unitary_scale(self.final_state)
+
+        print("Intermediate propagators initialized.")
+
+    def init_tf_propagator_starts(self):
+        # init_tf_propagator_batch for all the active starts: the propagators of the active starts and
+        # all time steps are computed by one batched matrix exponential, then multiplied together in a tf.scan
+        self.tf_matrix_list = self.get_tf_matrix_list()
+        active_num = tf.size(self.active_starts)
+        steps = self.sys_para.steps
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+
+        H_weights = tf.reshape(tf.transpose(tf.gather(self.H_weights, self.active_starts), [1, 0, 2]),
+                               [len(self.sys_para.Hnames) + 1, -1])
+        propagators = matexp_batch_op(H_weights, self.tf_matrix_list)
+        # shaped as (time_steps, active starts, 2*state_num, 2*state_num)
+        propagators = tf.transpose(tf.reshape(
+            propagators, [active_num, steps] + state_shape), [1, 0, 2, 3])
+        propagators.set_shape([steps, None] + state_shape)
+
+        self.init_tf_batch_states(propagators, active_num)
+
+    def init_tf_propagator_ensemble(self):
+        # init_tf_propagator_batch for all the Hamiltonian variants: the propagators of all variants
+        # and time steps are computed by one batched matrix exponential, then multiplied together in a tf.scan
+        self.tf_ensemble_list = self.get_tf_ensemble_list()
+        ensemble_size = self.sys_para.ensemble_size
+        steps = self.sys_para.steps
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+
+        propagators = matexp_ensemble_op(self.H_weights, self.tf_ensemble_list)
+        propagators.set_shape([ensemble_size, steps] + state_shape)
+        # shaped as (time_steps, variants, 2*state_num, 2*state_num)
+        propagators = tf.transpose(propagators, [1, 0, 2, 3])
+
+        self.init_tf_batch_states(propagators, ensemble_size)
+
+    def init_tf_batch_states(self, propagators, num):
+        # unitaries of num propagations (starts or variants), from their propagators shaped as
+        # (time_steps, num, 2*state_num, 2*state_num)
+        steps = self.sys_para.steps
+
+        def propagate(inter_state, propagator):
+            return tf.matmul(propagator, inter_state)
+
+        initial_unitaries = tf.tile(tf.expand_dims(
+            self.tf_initial_unitary, 0), [num, 1, 1])
+        initial_unitaries.set_shape([None] + self.tf_initial_unitary.get_shape().as_list())
+        self.inter_states_packed = tf.scan(propagate, propagators,
+                                           initializer=initial_unitaries, name="inter_states")
+
+        self.final_states = self.inter_states_packed[steps-1]
+
+        if self.sys_para.use_inter_vecs:
+            # shaped as (num, 2*state_num, time_steps+1, number of vectors)
+            inter_vecs = tf.einsum('tsij,jv->sitv', self.inter_states_packed,
+                                   self.packed_initial_vectors)
+            initial_vecs = tf.tile(tf.reshape(self.packed_initial_vectors, [1, self.sys_para.state_dim, 1, -1]),
+                                   [num, 1, 1, 1])
+            self.inter_vecs_batch = tf.concat([initial_vecs, inter_vecs], 2)
+            self.inter_vecs_batch.set_shape([None, self.sys_para.state_dim, self.sys_para.steps+1,
+                                             len(self.sys_para.initial_vectors)])
+        else:
+            self.inter_vecs_batch = None
+
+        print("Intermediate propagators initialized.")
+
+    def init_tf_inter_vector_state_starts(self):
+        # state transfer for all the active starts, propagating their vectors together
+        tf_matrix_list = self.get_tf_matrix_list()
+        input_num = len(self.sys_para.Hnames) + 1
+
+        def get_hamiltonians(uks):
+            # uks shaped as (num_starts, input_num)
+            return tf.tensordot(tf.cast(uks, self.state_dtype),
+                                tf_matrix_list[0:input_num], axes=1)
+
+        self.init_tf_inter_vector_state_batch(get_hamiltonians,
+                                              tf.transpose(tf.gather(
+                                                  self.H_weights, self.active_starts), [2, 0, 1]),
+                                              tf.size(self.active_starts))
+
+    def init_tf_inter_vector_state_ensemble(self):
+        # state transfer for all the Hamiltonian variants, propagating the vectors of all variants together
+        self.tf_ensemble_list = self.get_tf_ensemble_list()
+
+        def get_hamiltonians(uks):
+            # uks shaped as (input_num), shared by the variants
+            return tf.tensordot(self.tf_ensemble_list, tf.cast(uks, self.state_dtype), axes=[[1], [0]])
+
+        self.init_tf_inter_vector_state_batch(get_hamiltonians, tf.transpose(self.H_weights),
+                                              self.sys_para.ensemble_size)
+
+    def init_tf_inter_vector_state_batch(self, get_hamiltonians, uks_steps, num):
+        # state transfer for num propagations (starts or variants) together, with the batched matrix
+        # vector exponential of each time step: get_hamiltonians gives the (num, 2*state_num, 2*state_num)
+        # Hamiltonians from the uks of one time step
+
+        def propagate(psi, uks):
+            # psi shaped as (num, 2*state_num, number of vectors)
+            inter_vec = matvecexp_batch_op(get_hamiltonians(uks), psi)
+            inter_vec.set_shape(psi.get_shape())
+            return inter_vec
+
+        initial_vecs = tf.tile(tf.expand_dims(
+            self.packed_initial_vectors, 0), [num, 1, 1])
+        initial_vecs.set_shape(
+            [None] + self.packed_initial_vectors.get_shape().as_list())
+        inter_vecs = tf.scan(propagate, uks_steps,
+                             initializer=initial_vecs, name="inter_vecs")
+        inter_vecs = tf.concat([tf.expand_dims(initial_vecs, 0), inter_vecs], 0)
+        self.inter_vecs_batch = tf.transpose(inter_vecs, [1, 2, 0, 3])
+
+        self.final_states = self.inter_vecs_batch[:,
+                                                  :, self.sys_para.steps, :]
+
+        print("Vectors initialized.")
+
+    def get_tree_product(self, propagators):
+        # product K_n ... K_1 K_0 of the stacked propagators, by multiplying neighbouring pairs
+        # in a tree of log2(time_steps) batched matmuls
+        num = propagators.get_shape().as_list()[0]
+        while num > 1:
+            if num % 2 == 1:
+                # the last propagator has no partner, it is carried over to the next level
+                paired = tf.matmul(
+                    propagators[1:num:2], propagators[0:num-1:2])
+                propagators = tf.concat([paired, propagators[num-1:]], 0)
+            else:
+                propagators = tf.matmul(
+                    propagators[1::2], propagators[0::2])
+            num = (num+1)//2
+
+        return propagators[0]
+
+    def get_prefix_products(self, propagators):
+        # all the partial products K_i ... K_1 K_0 of the stacked propagators,
+        # by a work efficient parallel prefix scan of depth 2*log2(time_steps)
+        num = propagators.get_shape().as_list()[0]
+        if num < 2:
+            return propagators
+
+        # products of neighbouring pairs, then prefix products of the pairs give the odd elements
+        pairs_num = num//2
+        odd = self.get_prefix_products(tf.matmul(
+            propagators[1:2*pairs_num:2], propagators[0:2*pairs_num:2]))
+
+        # each even element is one more propagator on top of the preceding odd element
+        even = tf.concat([propagators[0:1], tf.matmul(
+            propagators[2::2], odd[0:(num-1)//2])], 0)
+
+        # interleave even and odd elements back to the time order
+        prefix = tf.reshape(tf.stack([even[0:pairs_num], odd], 1), [
+                            2*pairs_num] + propagators.get_shape().as_list()[1:])
+        if num % 2 == 1:
+            prefix = tf.concat([prefix, even[pairs_num:]], 0)
+
+        return prefix
+
+    def init_tf_propagator_tree(self):
+        # propagators of all time steps computed by one batched matrix exponential,
+        # then multiplied together in log2(time_steps) depth
+        self.tf_matrix_list = self.get_tf_matrix_list()
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+
+        # shaped as (time_steps, 2*state_num, 2*state_num)
+        self.tf_inter_state_op = matexp_batch_op(
+            self.H_weights, self.tf_matrix_list)
+        self.tf_inter_state_op.set_shape([self.sys_para.steps] + state_shape)
+
+        # the initial unitary is absorbed in the first propagator
+        propagators = tf.concat([tf.expand_dims(tf.matmul(self.tf_inter_state_op[0], self.tf_initial_unitary), 0),
+                                 self.tf_inter_state_op[1:]], 0)
+
+        if self.sys_para.use_inter_vecs:
+            self.inter_states_packed = self.get_prefix_products(propagators)
+            self.final_state = self.inter_states_packed[self.sys_para.steps-1]
+        else:
+            self.final_state = self.get_tree_product(propagators)
+
+        self.unitary_scale = self.get_unitary_scale(self.final_state)
+
+        print("Intermediate propagators initialized.")
+
+    def init_tf_propagator_reverse(self):
+        # propagation with a memory lean gradient: only the final unitary and the inter vectors are kept
+        self.tf_matrix_list = self.get_tf_matrix_list()
+        state_shape = [self.sys_para.state_dim, self.sys_para.state_dim]
+
+        if self.sys_para.use_inter_vecs:
+            self.final_state, inter_vecs = propagate_reverse_op(self.H_weights, self.tf_matrix_list,
+                                                                self.tf_initial_unitary, self.packed_initial_vectors)
+            inter_vecs.set_shape(
+                [self.sys_para.steps] + self.packed_initial_vectors.get_shape().as_list())
+
+            inter_vecs = tf.concat(
+                [tf.expand_dims(self.packed_initial_vectors, 0), inter_vecs], 0)
+            self.inter_vecs_packed = tf.transpose(inter_vecs, [1, 0, 2])
+            self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis=2)
+        else:
+            self.final_state = propagate_reverse_op(self.H_weights, self.tf_matrix_list,
+                                                    self.tf_initial_unitary, self.packed_initial_vectors)
+            self.inter_vecs = None
+        self.final_state.set_shape(state_shape)
+
+        self.unitary_scale = self.get_unitary_scale(self.final_state)
 
         print("Intermediate propagators initialized.")
 
@@ -244,19 +1226,29 @@ class TensorflowState:
 
         print("Vectors initialized.")
 
+    def init_tf_inter_vectors_scan(self):
+        # inter vectors for unitary evolution from the packed intermediate propagators
+        inter_vecs = tf.einsum('sij,jv->isv', self.inter_states_packed,
+                               self.packed_initial_vectors)
+        self.inter_vecs_packed = tf.concat(
+            [tf.expand_dims(self.packed_initial_vectors, 1), inter_vecs], 1)
+        self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis=2)
+
+        print("Vectors initialized.")
+
     def init_tf_inter_vector_state(self):
         # inter vectors for state transfer, obtained by evolving the initial vector
 
-        tf_matrix_list = tf.constant(
-            self.sys_para.matrix_list, dtype=tf.float32)
+        tf_matrix_list = self.get_tf_matrix_list()
 
         self.inter_vecs_list = []
         inter_vec = self.packed_initial_vectors
         self.inter_vecs_list.append(inter_vec)
 
+        vecexp_op = self.get_matvecexp_op()
         for ii in np.arange(0, self.sys_para.steps):
             psi = inter_vec
-            inter_vec = matvecexp_op(
+            inter_vec = vecexp_op(
                 self.H_weights[:, ii], tf_matrix_list, psi)
             self.inter_vecs_list.append(inter_vec)
         self.inter_vecs_packed = tf.stack(self.inter_vecs_list, axis=1)
@@ -264,8 +1256,35 @@ class TensorflowState:
 
         print("Vectors initialized.")
 
+    def init_tf_inter_vector_state_scan(self):
+        # same as init_tf_inter_vector_state, but looped over the time steps with tf.scan
+        tf_matrix_list = self.get_tf_matrix_list()
+        vecs_shape = self.packed_initial_vectors.get_shape()
+        vecexp_op = self.get_matvecexp_op()
+
+        def propagate(psi, uks):
+            inter_vec = vecexp_op(uks, tf_matrix_list, psi)
+            inter_vec.set_shape(vecs_shape)
+            return inter_vec
+
+        # shaped as (time_steps, 2*state_num, number of vectors)
+        inter_vecs = tf.scan(propagate, tf.transpose(self.H_weights),
+                             initializer=self.packed_initial_vectors, name="inter_vecs")
+        inter_vecs = tf.concat(
+            [tf.expand_dims(self.packed_initial_vectors, 0), inter_vecs], 0)
+        self.inter_vecs_packed = tf.transpose(inter_vecs, [1, 0, 2])
+        self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis=2)
+
+        print("Vectors initialized.")
+
     def get_inner_product(self, psi1, psi2):
         # Take 2 states psi1,psi2, calculate their overlap, for single vector
+        if self.sys_para.use_complex:
+            with tf.name_scope('inner_product'):
+                norm = tf.square(
+                    tf.abs(tf.reduce_sum(tf.multiply(psi1, tf.conj(psi2)))))
+            return norm
+
         state_num = self.sys_para.state_num
 
         psi_1_real = (psi1[0:state_num])
@@ -287,6 +1306,14 @@ class TensorflowState:
     def get_inner_product_2D(self, psi1, psi2):
         # Take 2 states psi1,psi2, calculate their overlap, for arbitrary number of vectors
         # psi1 and psi2 are shaped as (2*state_num, number of vectors)
+        if self.sys_para.use_complex:
+            # psi1 and psi2 are complex, shaped as (state_num, number of vectors)
+            with tf.name_scope('inner_product'):
+                overlap = tf.reduce_sum(tf.multiply(psi1, tf.conj(psi2)))
+                norm = tf.square(tf.abs(overlap)) / \
+                    (len(self.sys_para.states_concerned_list)**2)
+            return norm
+
         state_num = self.sys_para.state_num
 
         psi_1_real = (psi1[0:state_num, :])
@@ -309,6 +1336,15 @@ class TensorflowState:
     def get_inner_product_3D(self, psi1, psi2):
         # Take 2 states psi1,psi2, calculate their overlap, for arbitrary number of vectors and timesteps
         # psi1 and psi2 are shaped as (2*state_num, time_steps, number of vectors)
+        if self.sys_para.use_complex:
+            # psi1 and psi2 are complex, shaped as (state_num, time_steps, number of vectors)
+            with tf.name_scope('inner_product'):
+                overlaps = tf.reduce_sum(
+                    tf.multiply(psi1, tf.conj(psi2)), [0, 2])
+                norm = tf.reduce_sum(tf.square(tf.abs(overlaps))) / \
+                    (len(self.sys_para.states_concerned_list)**2)
+            return norm
+
         state_num = self.sys_para.state_num
 
         psi_1_real = (psi1[0:state_num, :])
@@ -329,26 +1365,129 @@ class TensorflowState:
                 (len(self.sys_para.states_concerned_list)**2)
         return norm
 
+    def get_batch_losses(self, ops_weights, positions=None):
+        # loss, regularization and unitary metric of each of the propagations in final_states
+        # and inter_vecs_batch (starts or variants), with the control weights ops_weights[ii].
+        # The propagation ii is at positions[ii] in final_states and inter_vecs_batch, if given
+        losses = []
+        reg_losses = []
+        scales = []
+        for ii in range(len(ops_weights)):
+            position = ii if positions is None else positions[ii]
+            final_state = tf.gather(self.final_states, position)
+            if self.sys_para.state_transfer:
+                final_vecs = final_state
+                scales.append(
+                    self.get_inner_product_2D(final_state, final_state))
+            else:
+                final_vecs = tf.matmul(final_state, self.packed_initial_vectors)
+                scales.append(self.get_unitary_scale(final_state))
+
+            loss = 1 - self.get_inner_product_2D(tf.cast(final_vecs, self.overlap_dtype),
+                                                 tf.cast(self.target_vecs, self.overlap_dtype))
+            losses.append(loss)
+
+            if self.inter_vecs_batch is None:
+                inter_vecs_packed = None
+                inter_vecs = None
+            else:
+                inter_vecs_packed = tf.gather(self.inter_vecs_batch, position)
+                inter_vecs = tf.unstack(inter_vecs_packed, axis=2)
+            reg_losses.append(get_reg_loss(StartState(self, loss=loss, ops_weight=ops_weights[ii],
+                                                      inter_vecs=inter_vecs, inter_vecs_packed=inter_vecs_packed)))
+
+        return tf.stack(losses), tf.stack(reg_losses), tf.stack(scales)
+
+    def init_training_loss_ensemble(self):
+        # loss and regularization of each variant, combined as their weighted average or their maximum;
+        # the first variant is the one shown and saved
+        self.ensemble_losses, ensemble_reg_losses, ensemble_scales = self.get_batch_losses(
+            [self.ops_weight]*self.sys_para.ensemble_size)
+
+        if self.sys_para.ensemble_loss == 'average':
+            weights = tf.constant(
+                self.sys_para.ensemble_weights, dtype=self.loss_dtype)
+            self.loss = tf.reduce_sum(weights*self.ensemble_losses)
+            self.reg_loss = tf.reduce_sum(weights*ensemble_reg_losses)
+        else:
+            self.loss = tf.reduce_max(self.ensemble_losses)
+            self.reg_loss = tf.reduce_max(ensemble_reg_losses)
+        self.optimized_loss = self.reg_loss
+
+        self.unitary_scale = ensemble_scales[0]
+        self.final_state = self.final_states[0]
+        if self.inter_vecs_batch is None:
+            self.inter_vecs = None
+        else:
+            self.inter_vecs_packed = self.inter_vecs_batch[0]
+            self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis=2)
+
+        print("Training loss initialized.")
+
+    def init_training_loss_starts(self):
+        # loss, regularization and unitary metric of each start; the best start (lowest loss)
+        # is the one shown, saved and returned. Only the active starts are propagated: the retired
+        # starts keep the loss they were retired with, and have no regularized loss
+        active = self.start_active > 0
+        # position of each active start among the propagated ones
+        positions = tf.maximum(tf.cumsum(tf.cast(active, tf.int32)) - 1, 0)
+        losses, reg_losses, start_scales = self.get_batch_losses(
+            tf.unstack(self.ops_weights), tf.unstack(positions))
+
+        self.retired_losses = tf.Variable(
+            tf.zeros([self.sys_para.num_starts], dtype=self.loss_dtype), trainable=False)
+        self.start_losses = tf.where(active, losses, self.retired_losses)
+        self.start_reg_losses = tf.where(
+            active, reg_losses, tf.zeros_like(reg_losses))
+        self.optimized_loss = tf.reduce_sum(self.start_reg_losses)
+
+        # the best start is never retired
+        self.best_start = tf.argmin(self.start_losses)
+        best_position = tf.gather(positions, self.best_start)
+        self.loss = self.start_losses[self.best_start]
+        self.reg_loss = self.start_reg_losses[self.best_start]
+        self.unitary_scale = start_scales[self.best_start]
+        self.ops_weight = tf.gather(self.ops_weights, self.best_start)
+        self.final_state = tf.gather(self.final_states, best_position)
+        if self.inter_vecs_batch is None:
+            self.inter_vecs = None
+        else:
+            self.inter_vecs_packed = tf.gather(
+                self.inter_vecs_batch, best_position)
+            self.inter_vecs = tf.unstack(self.inter_vecs_packed, axis=2)
+
+        print("Training loss initialized.")
+
     def init_training_loss(self):
         # Adding all penalties
+        if self.sys_para.num_starts > 1:
+            self.init_training_loss_starts()
+            return
+        if self.sys_para.ensemble is not None:
+            self.init_training_loss_ensemble()
+            return
+
         if self.sys_para.state_transfer == False:
 
             self.final_vecs = tf.matmul(
                 self.final_state, self.packed_initial_vectors)
 
             self.loss = 1 - \
-                self.get_inner_product_2D(self.final_vecs, self.target_vecs)
+                self.get_inner_product_2D(tf.cast(self.final_vecs, self.overlap_dtype),
+                                          tf.cast(self.target_vecs, self.overlap_dtype))
 
         else:
-            self.loss = tf.constant(0.0, dtype=tf.float32)
+            self.loss = tf.constant(0.0, dtype=self.loss_dtype)
             self.final_state = self.inter_vecs_packed[:,
                                                       self.sys_para.steps, :]
             self.loss = 1 - \
-                self.get_inner_product_2D(self.final_state, self.target_vecs)
+                self.get_inner_product_2D(tf.cast(self.final_state, self.overlap_dtype),
+                                          tf.cast(self.target_vecs, self.overlap_dtype))
             self.unitary_scale = self.get_inner_product_2D(
                 self.final_state, self.final_state)
 
         self.reg_loss = get_reg_loss(self)
+        self.optimized_loss = self.reg_loss
 
         print("Training loss initialized.")
 
@@ -358,19 +1497,160 @@ class TensorflowState:
         self.opt = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
 
         # Here we extract the gradients of the pulses
-        self.grad = self.opt.compute_gradients(self.reg_loss)
+        self.grad = self.opt.compute_gradients(self.optimized_loss)
 
         self.grad_pack = tf.stack([g for g, _ in self.grad])
 
         self.grads = [tf.nn.l2_loss(g) for g, _ in self.grad]
         self.grad_squared = tf.reduce_sum(tf.stack(self.grads))
-        self.optimizer = self.opt.apply_gradients(self.grad)
+        # the losses fetched with the Adam step are of the weights before the step
+        with tf.control_dependencies([self.loss, self.reg_loss]):
+            self.optimizer = self.opt.apply_gradients(self.grad)
+
+        if self.sys_para.num_starts > 1:
+            self.init_start_retirement()
+
+        if self.sys_para.lbfgs:
+            self.init_lbfgs()
+
+        if self.sys_para.second_order:
+            self.init_hessian_vector_product()
 
         print("Optimizer initialized.")
 
+    def init_hessian_vector_product(self):
+        # Hessian of the optimized loss with respect to the (fed) weights times hessian_vector, for the
+        # trust region optimizers: the gradient of the gradient along hessian_vector
+        self.hessian_vector = tf.placeholder(
+            self.real_dtype, self.sys_para.raw_shape)
+        grad = [g for g, v in self.grad if v is self.ops_weight_base][0]
+        self.hessian_vector_product = tf.gradients(
+            tf.reduce_sum(grad*self.hessian_vector), self.ops_weight_base_feed)[0]
+
+    def init_lbfgs(self):
+        # in-graph L-BFGS (method = 'LBFGS'): the last lbfgs_memory steps s and gradient changes y, the last
+        # accepted weights x_k and gradient g_k and the search direction stay in the graph, and only scalars
+        # are fetched by the line search of run_session
+        m = self.lbfgs_memory = 10
+        n = int(np.prod(self.sys_para.raw_shape))
+        dtype = self.real_dtype
+
+        def get_lbfgs_variable(shape):
+            return tf.Variable(tf.zeros(shape, dtype=dtype), trainable=False)
+
+        S = get_lbfgs_variable([m, n])
+        Y = get_lbfgs_variable([m, n])
+        rho = get_lbfgs_variable([m])
+        count = tf.Variable(0, trainable=False)
+        x_k = get_lbfgs_variable([n])
+        g_k = get_lbfgs_variable([n])
+        g = get_lbfgs_variable([n])
+        d = get_lbfgs_variable([n])
+
+        x = tf.reshape(self.ops_weight_base, [n])
+        grad = tf.reshape(
+            [g for g, v in self.grad if v is self.ops_weight_base][0], [n])
+
+        # the weights at a step along the direction from x_k
+        self.lbfgs_step = tf.placeholder(dtype, shape=[])
+        self.lbfgs_set_step = self.ops_weight_base.assign(
+            tf.reshape(x_k + self.lbfgs_step*d, self.sys_para.raw_shape))
+
+        # the optimized loss, loss, regularized loss and derivative along the direction at the weights,
+        # keeping their gradient in g
+        with tf.control_dependencies([g.assign(grad)]):
+            self.lbfgs_evaluate = [tf.identity(self.optimized_loss), tf.identity(self.loss),
+                                   tf.identity(self.reg_loss), tf.reduce_sum(grad*d)]
+
+        # forgets the history, x_k and g_k are the weights and their gradient
+        self.lbfgs_reset = tf.group(
+            x_k.assign(x), g_k.assign(g), count.assign(0))
+
+        # accepts the weights: the step and the gradient change are added to the history (when their
+        # curvature is positive), and the new direction is the two-loop recursion with the new history
+        s = x - x_k
+        y = g - g_k
+        sy = tf.reduce_sum(s*y)
+        store = sy > 1e-10*tf.reduce_sum(y*y)
+        S_new = tf.where(store, tf.concat([S[1:], [s]], 0), S)
+        Y_new = tf.where(store, tf.concat([Y[1:], [y]], 0), Y)
+        rho_new = tf.where(store, tf.concat(
+            [rho[1:], [1./tf.maximum(sy, 1e-30)]], 0), rho)
+        count_new = tf.where(store, tf.minimum(count + 1, m), count)
+        history = [S.assign(S_new), Y.assign(Y_new),
+                   rho.assign(rho_new), count.assign(count_new)]
+        with tf.control_dependencies(history):
+            history = history + [x_k.assign(x), g_k.assign(g)]
+
+        g_norm = tf.maximum(tf.sqrt(tf.reduce_sum(tf.square(g))), 1e-30)
+        # without history, the steps are along the gradient, of length one
+        steepest = -g/g_norm
+
+        q = tf.identity(g)
+        alphas = [None]*m
+        valid = [tf.cast(m - count_new <= ii, dtype) for ii in range(m)]
+        for ii in reversed(range(m)):
+            alphas[ii] = valid[ii]*rho_new[ii]*tf.reduce_sum(S_new[ii]*q)
+            q = q - alphas[ii]*Y_new[ii]
+        gamma = 1./(rho_new[m-1]*tf.maximum(tf.reduce_sum(tf.square(Y_new[m-1])), 1e-30))
+        r = tf.where(count_new > 0, gamma, 1./g_norm)*q
+        for ii in range(m):
+            beta = valid[ii]*rho_new[ii]*tf.reduce_sum(Y_new[ii]*r)
+            r = r + S_new[ii]*(alphas[ii] - beta)
+
+        # back to the gradient when the direction is not a descent direction
+        d_new = tf.where(tf.reduce_sum(g*r) > 0, -r, steepest)
+        with tf.control_dependencies(history + [d.assign(d_new)]):
+            # the directional derivative along the new direction, and the squared gradient
+            self.lbfgs_accept = [tf.reduce_sum(
+                g*d_new), 0.5*tf.reduce_sum(tf.square(g))]
+
+    def init_start_retirement(self):
+        # retired starts have no gradient, and their weights are restored after each Adam step,
+        # which would otherwise keep moving them with its momentum
+        retired_weights = tf.Variable(tf.zeros_like(
+            self.ops_weight_base), trainable=False)
+        active = tf.reshape(tf.cast(self.start_active, self.real_dtype), [-1, 1, 1]) * \
+            tf.ones_like(self.ops_weight_base)
+
+        with tf.control_dependencies([self.optimizer]):
+            self.optimizer = self.ops_weight_base.assign(
+                tf.where(active > 0, self.ops_weight_base, retired_weights))
+
+        # retire the hopeless starts, with a loss above retire_factor times the best loss, and the
+        # converged ones: squared gradient below min_grad, or relative decrease of the loss since the
+        # previous retirement below retire_tol. The best start is never retired
+        self.retire_factor = tf.placeholder(self.loss_dtype, shape=[])
+        self.retire_tol = tf.placeholder(self.loss_dtype, shape=[])
+        self.retire_min_grad = tf.placeholder(self.loss_dtype, shape=[])
+        checked_losses = tf.Variable(tf.fill([self.sys_para.num_starts], tf.constant(np.inf, dtype=self.loss_dtype)),
+                                     trainable=False)
+        grad = [g for g, v in self.grad if v is self.ops_weight_base][0]
+        start_grad_squared = tf.cast(
+            0.5*tf.reduce_sum(tf.square(grad), [1, 2]), self.loss_dtype)
+
+        hopeless = self.start_losses > self.retire_factor*self.loss
+        converged = tf.logical_or(start_grad_squared < self.retire_min_grad,
+                                  checked_losses - self.start_losses < self.retire_tol*checked_losses)
+        best = tf.cast(tf.one_hot(self.best_start,
+                                  self.sys_para.num_starts), tf.bool)
+        retire = tf.logical_and(tf.logical_and(self.start_active > 0, tf.logical_not(best)),
+                                tf.logical_or(hopeless, converged))
+
+        with tf.control_dependencies([retire]):
+            update_weights = retired_weights.assign(
+                tf.where(tf.logical_and(tf.reshape(retire, [-1, 1, 1]), active > 0), self.ops_weight_base, retired_weights))
+            update_losses = self.retired_losses.assign(
+                tf.where(retire, self.start_losses, self.retired_losses))
+            update_checked = checked_losses.assign(self.start_losses)
+        with tf.control_dependencies([update_weights, update_losses, update_checked]):
+            self.retire_starts = self.start_active.assign(
+                self.start_active*(1-tf.cast(retire, self.loss_dtype)))
+
     def init_utilities(self):
         # Add ops to save and restore all the variables.
         self.saver = tf.train.Saver()
+        self.init_op = tf.global_variables_initializer()
 
         print("Utilities initialized.")
 
@@ -387,14 +1667,43 @@ class TensorflowState:
             self.init_tf_propagators()
             self.init_tf_ops_weight()
             if self.sys_para.state_transfer == False:
-                self.init_tf_inter_propagators()
-                self.init_tf_propagator()
-                if self.sys_para.use_inter_vecs:
-                    self.init_tf_inter_vectors()
+                if self.sys_para.propagation == 'reverse':
+                    self.init_tf_propagator_reverse()
+                    if self.sys_para.use_inter_vecs:
+                        print("Vectors initialized.")
+                elif self.sys_para.num_starts > 1:
+                    self.init_tf_propagator_starts()
+                elif self.sys_para.ensemble is not None:
+                    self.init_tf_propagator_ensemble()
+                elif self.sys_para.propagation in ['scan', 'batched', 'tree']:
+                    if self.sys_para.propagation == 'scan':
+                        self.init_tf_propagator_scan()
+                    elif self.sys_para.propagation == 'batched':
+                        self.init_tf_propagator_batch()
+                    else:
+                        self.init_tf_propagator_tree()
+                    if self.sys_para.use_inter_vecs:
+                        self.init_tf_inter_vectors_scan()
+                    else:
+                        self.inter_vecs = None
                 else:
-                    self.inter_vecs = None
+                    self.init_tf_inter_propagators()
+                    self.init_tf_propagator()
+                    if self.sys_para.use_inter_vecs:
+                        self.init_tf_inter_vectors()
+                    else:
+                        self.inter_vecs = None
             else:
-                self.init_tf_inter_vector_state()
+                # the state vectors have to be propagated one step after the other, and only the vectors are kept,
+                # so the batched, tree and reverse propagations share the looped state transfer
+                if self.sys_para.num_starts > 1:
+                    self.init_tf_inter_vector_state_starts()
+                elif self.sys_para.ensemble is not None:
+                    self.init_tf_inter_vector_state_ensemble()
+                elif self.sys_para.propagation in ['scan', 'batched', 'tree', 'reverse']:
+                    self.init_tf_inter_vector_state_scan()
+                else:
+                    self.init_tf_inter_vector_state()
             self.init_training_loss()
             self.init_optimizer()
             self.init_utilities()
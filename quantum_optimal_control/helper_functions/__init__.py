@@ -1,4 +1,46 @@
 # IMPORTS
-from .data_management import *
-from .grape_functions import *
-from .qutip_verification import *
+# the modules are only imported when one of their names is first used, so that importing
+# the package (or only grape_functions) does not load qutip
+import importlib
+import sys
+import types
+
+_modules = {'H5File': 'data_management',
+            'OperatorCache': 'operator_cache',
+            'H5Writer': 'h5_writer',
+            'qutip_verification': 'qutip_verification'}
+_modules.update(dict.fromkeys(['dressed_unitary', 'get_dressed_info', 'qft', 'hamming_distance', 'Hadamard',
+                               'concerned', 'is_binary', 'transmon_gate', 'rz', 'rx', 'Bin', 'baseN', 'Basis',
+                               'kron_all', 'multi_kron', 'append_separate_krons', 'nn_chain_kron', 'sort_ev',
+                               'get_state_index', 'c_to_r_mat', 'c_to_r_vec'], 'grape_functions'))
+
+__all__ = list(_modules)
+
+
+class _Package(types.ModuleType):
+    def __setattr__(self, name, value):
+        # the import of a module sets it as an attribute of the package, after the module is run:
+        # a name shared with its module (qutip_verification) is bound to the object of the module instead
+        if isinstance(value, types.ModuleType) and _modules.get(name) == name:
+            value = getattr(value, name)
+        types.ModuleType.__setattr__(self, name, value)
+
+
+sys.modules[__name__].__class__ = _Package
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+
+    module = importlib.import_module('.' + _modules[name], __name__)
+    for module_name in _modules:
+        if _modules[module_name] == _modules[name]:
+            globals()[module_name] = getattr(module, module_name)
+
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
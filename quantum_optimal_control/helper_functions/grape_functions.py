@@ -1,5 +1,4 @@
 import numpy as np
-import scipy.linalg as la
 
 
 def dressed_unitary(U, v, dressed_id):
@@ -10,6 +9,7 @@ def dressed_unitary(U, v, dressed_id):
 
 def get_dressed_info(H0):
     # assign index of the dressed state according to the overall with bare state
+    import scipy.linalg as la
     w_c, v_c = la.eig(H0)
     dressed_id = []
     for ii in range(len(v_c)):
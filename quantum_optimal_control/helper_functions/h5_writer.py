@@ -0,0 +1,139 @@
+import numpy as np
+import queue
+import threading
+
+from quantum_optimal_control.helper_functions.data_management import H5File
+
+
+class H5Writer:
+
+    def __init__(self, file_path, max_queue=64, precision='float64', compression='gzip', chunk_size=2**20):
+        # background thread owning the open file: the datasets added or appended are queued (copied)
+        # and written in batches, so that the caller only waits for the disk when max_queue writes
+        # are already pending.
+        # The appended datasets are chunked (about chunk_size bytes per chunk) and compressed, and
+        # grow by one row per append, so that readers of the file (hf['error'][-1]) only see written
+        # rows, also while writing: growing a chunked dataset does not move its data.
+        # With precision = 'float32', the float64 (complex128) data is stored as float32 (complex64)
+        self.file_path = file_path
+        self.precision = precision
+        self.compression = compression
+        self.chunk_size = chunk_size
+        # rows written in each appended dataset
+        self.lengths = {}
+        self.queue = queue.Queue(max_queue)
+        self.error = None
+        self.error_reported = False
+        self.thread = threading.Thread(target=self.run, name='H5Writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, key, data):
+        self.put(('add', key, np.array(data)))
+
+    def append(self, key, data):
+        self.put(('append', key, np.array(data)))
+
+    def get_stored(self, data):
+        if self.precision == 'float32':
+            if data.dtype == np.float64:
+                return data.astype(np.float32)
+            if data.dtype == np.complex128:
+                return data.astype(np.complex64)
+
+        return data
+
+    def add_data(self, hf, key, data):
+        data = self.get_stored(data)
+        if key in hf:
+            del hf[key]
+        if data.ndim > 0 and data.dtype.kind in 'biufc':
+            hf.create_dataset(key, data=data, compression=self.compression)
+        else:
+            hf.create_dataset(key, data=data)
+
+    def append_data(self, hf, key, data):
+        data = self.get_stored(data)
+        if key not in self.lengths:
+            if key in hf:
+                del hf[key]
+            rows = max(1, min(64, self.chunk_size//max(data.nbytes, 1)))
+            hf.create_dataset(key, shape=(0,) + data.shape, maxshape=(None,) + data.shape,
+                              chunks=(rows,) + data.shape, dtype=data.dtype, compression=self.compression,
+                              shuffle=self.compression is not None)
+            self.lengths[key] = 0
+
+        dataset = hf[key]
+        length = self.lengths[key]
+        dataset.resize(length + 1, axis=0)
+        dataset[length] = data
+        self.lengths[key] = length + 1
+
+    def put(self, item):
+        # the errors of the writer thread are raised in the caller at its next write
+        self.check_error()
+        self.queue.put(item)
+
+    def check_error(self):
+        # raised once, the writes after an error are dropped
+        if self.error is not None and not self.error_reported:
+            self.error_reported = True
+            raise RuntimeError('writing to ' + str(self.file_path) +
+                               ' failed: ' + repr(self.error)) from self.error
+
+    def flush(self):
+        # waits until all the queued writes are in the file
+        self.queue.join()
+        self.check_error()
+
+    def close(self, raise_error=True):
+        # writes the queued data and stops the thread, an error of the writer thread is printed
+        # instead of raised with raise_error = False
+        self.queue.put(None)
+        self.thread.join()
+        if raise_error:
+            self.check_error()
+        elif self.error is not None and not self.error_reported:
+            self.error_reported = True
+            print('writing to ' + str(self.file_path) +
+                  ' failed: ' + repr(self.error))
+
+    def run(self):
+        hf = None
+        closing = False
+        while not closing:
+            # all the writes queued by now are written together, with one flush
+            items = [self.queue.get()]
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                if self.error is None:
+                    if hf is None:
+                        hf = H5File(self.file_path, 'a')
+                    for item in items:
+                        if item is None:
+                            break
+                        method, key, data = item
+                        if method == 'add':
+                            self.add_data(hf, key, data)
+                        else:
+                            self.append_data(hf, key, data)
+                    hf.flush()
+            except Exception as error:
+                # the error is raised in the caller
+                self.error = error
+            finally:
+                closing = None in items
+                for item in items:
+                    self.queue.task_done()
+
+        if hf is not None:
+            try:
+                hf.close()
+            except Exception as error:
+                if self.error is None:
+                    self.error = error
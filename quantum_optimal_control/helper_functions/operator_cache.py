@@ -0,0 +1,103 @@
+import numpy as np
+import contextlib
+import hashlib
+import os
+import tempfile
+import zipfile
+
+try:
+    import fcntl
+except ImportError:
+    # no lock between processes (Windows): the entries are still written atomically
+    fcntl = None
+
+
+class OperatorCache:
+
+    def __init__(self, cache_dir, max_size=2**30):
+        # the entries are .npz files named by the hash of their inputs, shared by all the processes
+        # using cache_dir. The least recently used entries are removed when the directory grows beyond
+        # max_size bytes
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_path = os.path.join(cache_dir, '.lock')
+
+    def get_key(self, *inputs):
+        # hash of the inputs, with their shapes and types so that different inputs with the same
+        # bytes have different keys
+        hasher = hashlib.sha256()
+        for value in inputs:
+            value = np.ascontiguousarray(value)
+            hasher.update((str(value.dtype) + str(value.shape)).encode('utf8'))
+            hasher.update(value.tobytes())
+
+        return hasher.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        # dictionary of the arrays of the entry, None if there is no entry for key
+        path = self.get_path(key)
+        try:
+            with np.load(path) as data:
+                entry = dict([(name, data[name]) for name in data.files])
+            # marks the entry as recently used
+            os.utime(path)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # missing, or removed by another process while reading
+            return None
+
+        return entry
+
+    def save(self, key, entry):
+        # the entry is written to a temporary file which replaces the previous entry at once,
+        # so that the other processes read either the whole previous entry or the whole new one
+        with self.lock():
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.savez(f, **entry)
+                os.replace(temp_path, self.get_path(key))
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+            self.evict()
+
+    def evict(self):
+        # removes the least recently used entries (but the newest) until the cache fits in max_size
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+
+        total_size = sum([size for mtime, size, name in entries])
+        for mtime, size, name in entries[:-1]:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            total_size -= size
+
+    @contextlib.contextmanager
+    def lock(self):
+        # exclusive lock of the cache directory between processes, for writing and evicting
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
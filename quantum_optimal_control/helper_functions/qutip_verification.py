@@ -1,9 +1,9 @@
 import numpy as np
 import h5py
-import qutip as qt
 
 
 def qutip_verification(datafile, atol):
+    import qutip as qt
 
     # load data from file
     with h5py.File(datafile, 'r') as hf:
@@ -1,2 +1,24 @@
 # IMPORTS
-from .grape import *
+# the modules are only imported when one of their names is first used
+import importlib
+
+_modules = {'Grape': 'grape',
+            'clear_graph_cache': 'grape',
+            'Sweep': 'sweep'}
+
+__all__ = list(_modules)
+
+
+def __getattr__(name):
+    if name not in _modules:
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+
+    globals()[name] = getattr(importlib.import_module(
+        '.' + _modules[name], __name__), name)
+
+    return globals()[name]
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,20 +1,31 @@
-import tensorflow.compat.v1 as tf
 import numpy as np
-import scipy.linalg as la
-from quantum_optimal_control.core.tensorflow_state import TensorflowState
+from quantum_optimal_control.core.numpy_state import NumpyState
 from quantum_optimal_control.core.system_parameters import SystemParameters
 from quantum_optimal_control.core.convergence import Convergence
-from quantum_optimal_control.core.run_session import run_session
+from quantum_optimal_control.core.run_session import run_session, numpy_run_session
 
+import collections
 import random as rd
 import time
-from IPython import display
 
 from quantum_optimal_control.helper_functions.data_management import H5File
 import os
 
 
-def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, convergence=None, U0=None, reg_coeffs=None, dressed_info=None, maxA=None, use_gpu=True, sparse_H=True, sparse_U=False, sparse_K=False, draw=None, initial_guess=None, show_plots=True, unitary_error=1e-4, method='Adam', state_transfer=False, no_scaling=False, freq_unit='GHz', file_name=None, save=True, data_path=None, Taylor_terms=None, use_inter_vecs=True):
+# graphs and open sessions of the previous Grape calls with cache_graph, by graph key of their system,
+# the least recently used first: beyond graph_cache_size graphs, its session is closed
+graph_cache = collections.OrderedDict()
+graph_cache_size = 4
+
+
+def clear_graph_cache():
+    # closes the sessions of the cached graphs
+    for tfs, graph, session in list(graph_cache.values()):
+        session.close()
+    graph_cache.clear()
+
+
+def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, convergence=None, U0=None, reg_coeffs=None, dressed_info=None, maxA=None, use_gpu=True, sparse_H=None, sparse_U=False, sparse_K=False, draw=None, initial_guess=None, show_plots=True, unitary_error=1e-4, method='Adam', state_transfer=False, no_scaling=False, freq_unit='GHz', file_name=None, save=True, data_path=None, Taylor_terms=None, use_inter_vecs=True, propagation='unrolled', use_complex=False, precision='float32', exact_gradient=False, checkpoints=None, exp_method='auto', krylov_dim=None, engine='tensorflow', num_starts=1, ensemble=None, num_threads=None, cache_graph=False, operator_cache=None, operator_cache_size=2**30, save_policy=None):
 
     # start time
     grape_start_time = time.time()
@@ -23,14 +34,20 @@ def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, converg
     freq_time_unit_dict = {"GHz": "ns", "MHz": "us", "KHz": "ms", "Hz": "s"}
     time_unit = freq_time_unit_dict[freq_unit]
 
-    # make sparse_{H,U,K} False if use_gpu is True, as GPU Sparse Matmul is not supported yet.
+    # the sparse Hamiltonians are the default on CPU only, on GPU they are used with sparse_H = True,
+    # and the sparsity hints of the dense matmuls (sparse_U, sparse_K) are not supported on GPU
+    if sparse_H is None:
+        sparse_H = not use_gpu
     if use_gpu:
-        sparse_H = False
         sparse_U = False
         sparse_K = False
 
     file_path = None
 
+    if method.upper() == 'LBFGS' and engine != 'tensorflow':
+        raise ValueError(
+            'The in-graph LBFGS method is only available with the tensorflow engine')
+
     if save:
         # saves all the input values
         if file_name is None:
@@ -63,6 +80,21 @@ def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, converg
             hf.add('sparse_H', data=sparse_H)
             hf.add('sparse_U', data=sparse_U)
             hf.add('sparse_K', data=sparse_K)
+            hf.add('propagation', propagation.encode('utf8'))
+            hf.add('use_complex', data=use_complex)
+            hf.add('precision', precision.encode('utf8'))
+            hf.add('exact_gradient', data=exact_gradient)
+            if not checkpoints is None:
+                hf.add('checkpoints', data=checkpoints)
+            hf.add('exp_method', exp_method.encode('utf8'))
+            if not krylov_dim is None:
+                hf.add('krylov_dim', data=krylov_dim)
+            hf.add('engine', engine.encode('utf8'))
+            hf.add('num_starts', data=num_starts)
+            if not num_threads is None:
+                hf.add('num_threads', data=num_threads)
+            if not operator_cache is None:
+                hf.add('operator_cache', operator_cache.encode('utf8'))
 
             if not maxA is None:
                 hf.add('maxA', data=maxA)
@@ -85,6 +117,17 @@ def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, converg
                 for k, v in list(dressed_info.items()):
                     g3.create_dataset(k, data=v)
 
+            if not ensemble is None:
+                g4 = hf.create_group('ensemble')
+                for k, v in list(ensemble.items()):
+                    g4.create_dataset(k, data=v)
+
+            if not save_policy is None:
+                g5 = hf.create_group('save_policy')
+                for k, v in list(save_policy.items()):
+                    if not v is None:
+                        g5.create_dataset(k, data=v)
+
     if U0 is None:
         U0 = np.identity(len(H0))
     if convergence is None:
@@ -101,23 +144,56 @@ def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, converg
 
     # pass in system parameters
     sys_para = SystemParameters(H0, Hops, Hnames, U, U0, total_time, steps, states_concerned_list, dressed_info, maxAmp, draw, initial_guess,  show_plots,
-                                unitary_error, state_transfer, no_scaling, reg_coeffs, save, file_path, Taylor_terms, use_gpu, use_inter_vecs, sparse_H, sparse_U, sparse_K)
-
-    if use_gpu:
-        dev = '/gpu:0'
-    else:
-        dev = '/cpu:0'
-
-    with tf.device(dev):
-        tfs = TensorflowState(sys_para)  # create tensorflow graph
-        graph = tfs.build_graph()
+                                unitary_error, state_transfer, no_scaling, reg_coeffs, save, file_path, Taylor_terms, use_gpu, use_inter_vecs, sparse_H, sparse_U, sparse_K,
+                                propagation=propagation, use_complex=use_complex, precision=precision,
+                                exact_gradient=exact_gradient, checkpoints=checkpoints, exp_method=exp_method, krylov_dim=krylov_dim, engine=engine, num_starts=num_starts, ensemble=ensemble, num_threads=num_threads,
+                                operator_cache=operator_cache, operator_cache_size=operator_cache_size, save_policy=save_policy,
+                                second_order=method.upper() in ['TRUST-NCG', 'TRUST-KRYLOV'], lbfgs=method.upper() == 'LBFGS', cache_graph=cache_graph and engine == 'tensorflow')
+
+    if engine == 'tensorflow':
+        import tensorflow.compat.v1 as tf
+        from quantum_optimal_control.core.tensorflow_state import TensorflowState
+
+        if use_gpu:
+            dev = '/gpu:0'
+        else:
+            dev = '/cpu:0'
+
+        session = None
+        if cache_graph:
+            key = sys_para.get_graph_key()
+            if key in graph_cache:
+                # same graph: the new system is loaded into its variables by run_session
+                tfs, graph, session = graph_cache[key]
+                graph_cache.move_to_end(key)
+                print("Using the cached graph")
+
+        if session is None:
+            with tf.device(dev):
+                tfs = TensorflowState(sys_para)  # create tensorflow graph
+                graph = tfs.build_graph()
 
     conv = Convergence(sys_para, time_unit, convergence)
 
     # run the optimization
     try:
-        SS = run_session(tfs, graph, conv, sys_para, method,
-                         show_plots=sys_para.show_plots, use_gpu=use_gpu)
+        if engine == 'numpy':
+            SS = numpy_run_session(NumpyState(sys_para), conv, sys_para, method,
+                                   show_plots=sys_para.show_plots)
+        else:
+            try:
+                SS = run_session(tfs, graph, conv, sys_para, method,
+                                 show_plots=sys_para.show_plots, use_gpu=use_gpu, session=session, keep_session=cache_graph)
+            except BaseException:
+                # the variables of a failed run may be left mid-update: its graph and session are not reused
+                if cache_graph and key in graph_cache:
+                    graph_cache.pop(key)[2].close()
+                raise
+            if cache_graph:
+                graph_cache[key] = (tfs, graph, SS.session)
+                while len(graph_cache) > graph_cache_size:
+                    oldest_key, (oldest_tfs, oldest_graph, oldest_session) = graph_cache.popitem(last=False)
+                    oldest_session.close()
 
         # save wall clock time
         if save:
@@ -136,4 +212,5 @@ def Grape(H0, Hops, Hnames, U, total_time, steps, states_concerned_list, converg
                 hf.add('wall_clock_time', data=np.array(wall_clock_time))
             print("data saved at: " + str(file_path))
 
+        from IPython import display
         display.clear_output()
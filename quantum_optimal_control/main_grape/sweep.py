@@ -0,0 +1,201 @@
+import numpy as np
+import itertools
+import multiprocessing
+import os
+import queue
+import time
+
+from quantum_optimal_control.helper_functions.data_management import H5File
+
+
+# environment variables read by the BLAS and OpenMP libraries when the worker processes start
+thread_variables = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']
+
+
+def Sweep(grape_args, sweep, get_args=None, num_workers=None, threads_per_worker=1, warm_start=True, file_name=None, data_path=None):
+
+    # start time
+    sweep_start_time = time.time()
+
+    if file_name is None:
+        raise ValueError('Sweep function input: file_name, is not specified.')
+
+    if data_path is None:
+        raise ValueError('Sweep function input: data_path, is not specified.')
+
+    # the points are the grid over the swept values, in the order of the sweep dictionary
+    names = list(sweep)
+    indices = list(itertools.product(
+        *[range(len(sweep[name])) for name in names]))
+    points = [dict([(name, sweep[name][ii]) for name, ii in zip(names, index)])
+              for index in indices]
+
+    if num_workers is None:
+        num_workers = max(1, (os.cpu_count() or 1)//threads_per_worker)
+
+    file_num = 0
+    while (os.path.exists(os.path.join(data_path, str(file_num).zfill(5) + "_" + file_name+".h5"))):
+        file_num += 1
+    file_path = os.path.join(
+        data_path, str(file_num).zfill(5) + "_" + file_name + ".h5")
+
+    # the worker processes are spawned (not forked from a process that may have loaded tensorflow),
+    # with their thread counts pinned by the environment they inherit
+    saved_environ = dict([(var, os.environ.get(var))
+                          for var in thread_variables])
+    for var in thread_variables:
+        os.environ[var] = str(threads_per_worker)
+    try:
+        pool = multiprocessing.get_context('spawn').Pool(num_workers)
+    finally:
+        for var in thread_variables:
+            if saved_environ[var] is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = saved_environ[var]
+
+    uks = [None]*len(points)
+    errors = np.zeros(len(points))
+    reg_errors = np.zeros(len(points))
+    run_times = np.zeros(len(points))
+    point_paths = [None]*len(points)
+    warm_starts = -np.ones(len(points), dtype=int)
+
+    # finished points are collected from the pool callbacks
+    finished = queue.Queue()
+    pending = list(range(len(points)))
+    running = 0
+
+    try:
+        while pending or running > 0:
+            # each new point starts from the pulses of the nearest finished point
+            while pending and running < num_workers:
+                ii = pending.pop(0)
+                args = get_point_args(grape_args, points[ii], get_args)
+                args['file_name'] = file_name + '_point' + str(ii).zfill(4)
+                args['data_path'] = data_path
+                args['num_threads'] = threads_per_worker
+
+                if warm_start:
+                    jj = get_nearest_point(indices, ii, uks)
+                    if jj is not None and len(uks[jj]) == len(args['Hops']):
+                        args['initial_guess'] = resample_uks(
+                            uks[jj], args['steps'], args.get('maxA'))
+                        warm_starts[ii] = jj
+                        if args.get('maxA') is None:
+                            # otherwise Grape would bound the amplitudes by the initial guess
+                            args['maxA'] = 4*np.ones(len(args['Hops']))
+
+                # a failed point is queued as its index and its exception
+                pool.apply_async(run_point, (ii, args), callback=finished.put,
+                                 error_callback=lambda exception, ii=ii: finished.put((ii, exception)))
+                running += 1
+
+            result = finished.get()
+            running -= 1
+            if len(result) == 2:
+                # the other points go on: the failed point has no pulses, a nan error and no file
+                ii, exception = result
+                errors[ii] = np.nan
+                reg_errors[ii] = np.nan
+                run_times[ii] = np.nan
+                point_paths[ii] = ''
+                print("Sweep point %d of %d failed: %r" %
+                      (len(points) - len(pending) - running, len(points), exception))
+                continue
+            ii, point_uks, point_path, error, reg_error, run_time = result
+            uks[ii] = np.array(point_uks)
+            point_paths[ii] = point_path
+            errors[ii] = error
+            reg_errors[ii] = reg_error
+            run_times[ii] = run_time
+            print("Sweep point %d of %d done, error = %.9f" %
+                  (len(points) - len(pending) - running, len(points), error))
+    finally:
+        pool.terminate()
+
+    # summary of all the points, indexed as the sweep grid
+    with H5File(file_path, 'w') as hf:
+        hf.add('names', data=[name.encode('utf8') for name in names])
+        hf.add('index', data=np.array(indices))
+        g1 = hf.create_group('values')
+        for name in names:
+            values = np.array([point[name] for point in points])
+            if values.dtype.kind == 'U':
+                # strings (method, propagation, ...) are stored as bytes
+                values = np.char.encode(values, 'utf8')
+            g1.create_dataset(name, data=values)
+        hf.add('error', data=errors)
+        hf.add('reg_error', data=reg_errors)
+        hf.add('run_time', data=run_times)
+        hf.add('warm_start', data=warm_starts)
+        hf.add('file_paths', data=[point_path.encode('utf8')
+                                   for point_path in point_paths])
+        g2 = hf.create_group('uks')
+        for ii in range(len(points)):
+            if uks[ii] is not None:
+                g2.create_dataset(str(ii).zfill(4), data=uks[ii])
+        hf.add('wall_clock_time', data=np.array(
+            time.time() - sweep_start_time))
+
+    print("sweep saved at: " + str(file_path))
+
+    return points, uks, errors, file_path
+
+
+def get_point_args(grape_args, point, get_args):
+    # Grape arguments of one point: the swept Grape arguments, and the ones given by get_args
+    args = dict(grape_args)
+    if get_args is None:
+        args.update(point)
+    else:
+        args.update(get_args(point))
+    args['show_plots'] = False
+    args['save'] = True
+
+    return args
+
+
+def get_nearest_point(indices, ii, uks):
+    # the finished point nearest to point ii on the sweep grid, None if no point is finished
+    nearest = None
+    nearest_distance = np.inf
+    for jj in range(len(indices)):
+        if uks[jj] is not None:
+            distance = np.sum(np.square(np.subtract(indices[jj], indices[ii])))
+            if distance < nearest_distance:
+                nearest = jj
+                nearest_distance = distance
+
+    return nearest
+
+
+def resample_uks(uks, steps, maxA=None):
+    # pulses interpolated from their time steps onto steps time steps of the same (relative) gate time
+    old_times = (np.arange(uks.shape[1]) + 0.5)/uks.shape[1]
+    new_times = (np.arange(steps) + 0.5)/steps
+    initial_guess = np.array([np.interp(new_times, old_times, uk)
+                              for uk in uks])
+
+    if maxA is not None:
+        # slightly inside the bounds, where the weights (arcsin of the pulses) still have a gradient
+        bounds = 0.99*np.reshape(maxA, [-1, 1])
+        initial_guess = np.clip(initial_guess, -bounds, bounds)
+
+    # a list of k pulses, as the initial_guess of Grape
+    return list(initial_guess)
+
+
+def run_point(ii, args):
+    # optimization of one point in a worker process
+    from quantum_optimal_control.main_grape.grape import Grape
+
+    start_time = time.time()
+    uks, Uf, point_path = Grape(**args)
+
+    with H5File(point_path, 'r') as hf:
+        error = np.array(hf['error'])[-1]
+        reg_error = np.array(hf['reg_error'])[-1]
+
+    return ii, np.array(uks), point_path, error, reg_error, time.time() - start_time
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds allowed to import the helper functions (about 0.15s, it was 5s with tensorflow)
+HELPER_IMPORT_BUDGET = 1.
+
+
+def run_python(code):
+    # output of code run in a new interpreter, with the package of this tree
+    return subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, universal_newlines=True)
+
+
+class TestImports(unittest.TestCase):
+
+    def test_helper_import_budget(self):
+        output = run_python("""
+import sys
+import time
+start = time.time()
+from quantum_optimal_control import transmon_gate, c_to_r_mat
+print(time.time() - start)
+print(' '.join([name for name in ['tensorflow', 'matplotlib', 'IPython', 'qutip'] if name in sys.modules]))
+""").split('\n')
+
+        self.assertLess(float(output[0]), HELPER_IMPORT_BUDGET)
+        self.assertEqual(output[1], '')
+
+    def test_names_shared_with_modules(self):
+        # run_session and qutip_verification are the class and the function, also after
+        # their modules are imported
+        for imports in ['', 'import quantum_optimal_control.main_grape.grape',
+                        'import quantum_optimal_control.core.run_session',
+                        'import quantum_optimal_control.helper_functions.qutip_verification']:
+            output = run_python(imports + """
+import inspect
+import quantum_optimal_control as qoc
+print(inspect.isclass(qoc.run_session), inspect.isclass(qoc.core.run_session),
+      inspect.isfunction(qoc.qutip_verification), inspect.isfunction(qoc.helper_functions.qutip_verification))
+""")
+
+            self.assertEqual(output.split(), ['True']*4, imports)
+
+
+if __name__ == '__main__':
+    unittest.main()